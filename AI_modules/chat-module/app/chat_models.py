@@ -35,7 +35,7 @@ If you do not have sufficient knowledge to answer the query, say "Sorry, I do no
       retrieval_query = ""
       for message in input_messages:
         retrieval_query += f'{message["role"]}: {message["content"]}\n\n'
-      res = requests.post(f"{self.vectorstore_url}/retrieve/", json={"query":  retrieval_query})
+      res = requests.post(f"{self.vectorstore_url}/retrieve/", json={"query":  retrieval_query, "mode": "auto"})
       res_json = res.json()
       retrieved_docs = res_json["docs"]
       context = ""
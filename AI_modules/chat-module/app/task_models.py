@@ -440,10 +440,11 @@ Think step-by-step before providing the condensed list: <response>"""
 
       # Extract key topics for context for each topic
       extracted_topics = ""
-      for topic in condensed_topics:
-        res = requests.post(f"{self.vectorstore_url}/retrieve/", json={"query":  topic, "k": 3})
-        res_json = res.json()
-        retrieved_docs = res_json["docs"]
+      # Retrieve the context of all topics in one batched request
+      res = requests.post(f"{self.vectorstore_url}/retrieve_batch/", json={"queries":  condensed_topics, "k": 3})
+      res_json = res.json()
+      for topic, topic_result in zip(condensed_topics, res_json["results"]):
+        retrieved_docs = topic_result["docs"]
         context = ""
         if len(retrieved_docs) > 0:
           for doc in retrieved_docs:
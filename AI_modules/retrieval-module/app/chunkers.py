@@ -0,0 +1,49 @@
+import os
+from langchain_text_splitters import RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter
+from embedding_models import embedding_model
+
+
+class CharacterChunker():
+  # Splits by character count, the original chunking of HybridSearch
+  def __init__(self, chunk_size: int=4000, chunk_overlap: int=1500):
+    self.text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+        is_separator_regex=False,
+    )
+
+  def split(self, document: str):
+    return self.text_splitter.split_text(document)
+
+
+class TokenChunker():
+  # Splits by the token count of the embedding tokenizer so that no chunk is truncated when embedded
+  def __init__(self, tokenizer, chunk_size: int=480, chunk_overlap: int=64):
+    self.text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(tokenizer, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+  def split(self, document: str):
+    return self.text_splitter.split_text(document)
+
+
+class MarkdownChunker():
+  # Splits the pymupdf4llm markdown at its headings first so that chunks do not span sections,
+  # sections longer than chunk_size tokens are split further by token count
+  def __init__(self, tokenizer, chunk_size: int=480, chunk_overlap: int=64):
+    self.header_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=[("#", "h1"), ("##", "h2"), ("###", "h3")], strip_headers=False)
+    self.token_chunker = TokenChunker(tokenizer, chunk_size, chunk_overlap)
+
+  def split(self, document: str):
+    chunks = []
+    for section in self.header_splitter.split_text(document):
+      chunks.extend(self.token_chunker.split(section.page_content))
+    return chunks
+
+
+chunk_tokens = int(os.getenv("CHUNK_TOKENS", "480"))
+chunk_overlap_tokens = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))
+chunkers = {
+  "character": CharacterChunker(chunk_size=int(os.getenv("CHUNK_CHARACTERS", "4000")), chunk_overlap=int(os.getenv("CHUNK_OVERLAP_CHARACTERS", "1500"))),
+  "token": TokenChunker(embedding_model.tokenizer, chunk_tokens, chunk_overlap_tokens),
+  "markdown": MarkdownChunker(embedding_model.tokenizer, chunk_tokens, chunk_overlap_tokens),
+}
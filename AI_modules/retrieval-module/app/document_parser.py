@@ -0,0 +1,87 @@
+import os
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pymupdf
+import pymupdf4llm
+
+
+def identify_headers(filepath: str, filetype):
+  # Font sizes of the markdown headers, found by scanning the text of every page of the document
+  with pymupdf.open(filepath, filetype=filetype) as doc:
+    return pymupdf4llm.IdentifyHeaders(doc)
+
+
+def convert_pages(filepath: str, filetype, pages: list, hdr_info=None):
+  # Runs in a worker process, converts the given pages of the document to markdown
+  # Without hdr_info, to_markdown scans the whole document for the header sizes on every call
+  with pymupdf.open(filepath, filetype=filetype) as doc:
+    return pymupdf4llm.to_markdown(doc, pages=pages, hdr_info=hdr_info)
+
+
+class DocumentParser():
+  # Converts documents to markdown in a pool of worker processes so that parsing neither holds the GIL
+  # of the retrieval module nor is limited to one core, at most max_pending page ranges are queued
+  # and callers wait for a free slot when the queue is full
+  # With max_workers=0 the pages are converted in the calling thread
+  def __init__(self, max_workers: int=2, max_pending: int=8):
+    self.max_workers = max_workers
+    self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+    self.executor = None
+    if max_workers > 0:
+      # Spawn the workers so that they do not inherit the model threads and CUDA state of this process
+      self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+  def page_count(self, filepath: str, filetype=None):
+    with pymupdf.open(filepath, filetype=filetype) as doc:
+      return doc.page_count
+
+
+  def submit(self, filepath: str, filetype, pages: list, hdr_info=None):
+    self.slots.acquire()
+    try:
+      future = self.executor.submit(convert_pages, filepath, filetype, pages, hdr_info)
+    except Exception:
+      self.slots.release()
+      raise
+    future.add_done_callback(lambda future: self.slots.release())
+    return future
+
+
+  def iter_markdown(self, filepath: str, filetype=None, page_batch_size: int=10, lookahead: int=None):
+    # Yields the markdown of each range of page_batch_size pages in page order
+    # Up to lookahead ranges of the document are converted in parallel ahead of the consumer
+    page_ranges = [list(range(start, min(start + page_batch_size, page_count)))
+                   for page_count in [self.page_count(filepath, filetype)] for start in range(0, page_count, page_batch_size)]
+    # The header sizes are identified once per document and passed to every page range
+    if self.executor is None:
+      hdr_info = identify_headers(filepath, filetype)
+      for pages in page_ranges:
+        yield convert_pages(filepath, filetype, pages, hdr_info)
+      return
+    hdr_info = self.executor.submit(identify_headers, filepath, filetype).result()
+    if lookahead is None:
+      lookahead = self.max_workers
+    futures = deque()
+    try:
+      for pages in page_ranges:
+        futures.append(self.submit(filepath, filetype, pages, hdr_info))
+        if len(futures) >= lookahead:
+          yield futures.popleft().result()
+      while len(futures) > 0:
+        yield futures.popleft().result()
+    finally:
+      # Drop the remaining ranges if the consumer stopped early
+      for future in futures:
+        future.cancel()
+
+
+  def shutdown(self):
+    if self.executor is not None:
+      self.executor.shutdown(wait=False, cancel_futures=True)
+    return
+
+
+document_parser = DocumentParser(max_workers=int(os.getenv("PARSER_WORKERS", "2")), max_pending=int(os.getenv("PARSER_MAX_PENDING", "8")))
@@ -1,32 +1,265 @@
 from FlagEmbedding import FlagModel, FlagReranker
+from transformers import AutoTokenizer
 
 import torch
 import os
+import hashlib
+import threading
+from collections import OrderedDict
 #Use GPU if available
 if not torch.cuda.is_available():
   os.environ["CUDA_VISIBLE_DEVICES"] = ""
 
 
+def load_flag(model_class, model_str: str):
+  # FlagEmbedding runs the model in fp16 on GPU and in fp32 on CPU
+  return model_class(model_str, use_fp16=True)
+
+
+def load_int8(model_class, model_str: str):
+  # Dynamic int8 quantization of the linear layers for CPU inference, the weights are stored in int8
+  # and the activations are quantized batch by batch, tokenization and pooling stay with FlagEmbedding
+  flag_model = model_class(model_str, use_fp16=False)
+  model = flag_model.model.module if isinstance(flag_model.model, torch.nn.DataParallel) else flag_model.model
+  flag_model.model = torch.ao.quantization.quantize_dynamic(model.float().cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+  flag_model.model.eval()
+  flag_model.device = torch.device("cpu")
+  flag_model.num_gpus = 0
+  return flag_model
+
+
+# Inference backend name -> function loading a FlagModel or FlagReranker with that backend
+inference_backends = {"flag": load_flag, "int8": load_int8}
+
+
+class EmbeddingCache():
+  # Thread-safe LRU cache of query embeddings bounded by the bytes of the cached entries
+  def __init__(self, max_bytes: int=64 * 1024 * 1024):
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    self.size_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def normalize(query: str):
+    # The bge tokenizer is uncased and ignores repeated whitespace, so these queries embed identically
+    return " ".join(query.lower().split())
+
+  @staticmethod
+  def entry_bytes(key, embedding):
+    return len(key.encode()) + embedding.nbytes
+
+  def get(self, query: str):
+    key = self.normalize(query)
+    with self.lock:
+      embedding = self.entries.get(key)
+      if embedding is None:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return embedding
+
+  def put(self, query: str, embedding):
+    key = self.normalize(query)
+    size = self.entry_bytes(key, embedding)
+    if size > self.max_bytes:
+      return
+    # Cache a copy, a row of a batch would keep the whole batch array alive, and cached arrays are shared between requests
+    embedding = embedding.copy()
+    embedding.setflags(write=False)
+    with self.lock:
+      if key in self.entries:
+        self.size_bytes -= self.entry_bytes(key, self.entries.pop(key))
+      self.entries[key] = embedding
+      self.size_bytes += size
+      while self.size_bytes > self.max_bytes:
+        old_key, old_embedding = self.entries.popitem(last=False)
+        self.size_bytes -= self.entry_bytes(old_key, old_embedding)
+    return
+
+  def stats(self):
+    with self.lock:
+      return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "size_bytes": self.size_bytes, "max_bytes": self.max_bytes}
+
+
 class EmbeddingModel():
   embedding_dims = 768
-  def __init__(self):
-    self.embedding_model = FlagModel('BAAI/bge-base-en-v1.5',
-                                     use_fp16=True) # Setting use_fp16 to True speeds up computation with a slight performance degradation
+  model_str = 'BAAI/bge-base-en-v1.5'
+  def __init__(self, cache_bytes: int=64 * 1024 * 1024, backend: str="flag", lazy: bool=False):
+    if backend not in inference_backends:
+      raise ValueError(f"Invalid inference backend: {backend}. Choose from {', '.join(inference_backends)}.")
+    self.backend = backend
+    # With lazy=True the weights are loaded by load(), on first use or by the background startup of the server
+    self.embedding_model = None
+    self.load_lock = threading.Lock()
+    if lazy:
+      self.tokenizer = AutoTokenizer.from_pretrained(self.model_str) # Same tokenizer as the model, loaded without the weights
+    else:
+      self.tokenizer = self.load().tokenizer # Used to chunk documents by token count
+    self.max_tokens = 512 # Longer texts are truncated when embedded
+    # Only single queries are cached, documents are embedded once when uploaded
+    self.cache = EmbeddingCache(cache_bytes) if cache_bytes > 0 else None
+
+  def load(self):
+    # Returns the model, loading it if it is not loaded yet
+    with self.load_lock:
+      if self.embedding_model is None:
+        self.embedding_model = inference_backends[self.backend](FlagModel, self.model_str)
+    return self.embedding_model
+
+  def warm_up(self):
+    # Loads the model and embeds a query so that the first request does not pay for CUDA initialization
+    self.load().encode(["warm up"])
+    return
                                     
   def encode(self, query):
-    embedding = self.embedding_model.encode(query)
+    embedding_model = self.embedding_model or self.load()
+    if self.cache is None or not isinstance(query, str):
+      embedding = embedding_model.encode(query)
+      return embedding
+    embedding = self.cache.get(query)
+    if embedding is None:
+      embedding = embedding_model.encode(query)
+      self.cache.put(query, embedding)
     return embedding
 
+  def encode_batch(self, queries: list):
+    # Embeds a list of queries, cache misses are embedded together in one batch
+    embedding_model = self.embedding_model or self.load()
+    if self.cache is None:
+      return list(embedding_model.encode(queries))
+    embeddings = [self.cache.get(query) for query in queries]
+    misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if len(misses) > 0:
+      miss_embeddings = embedding_model.encode([queries[i] for i in misses])
+      for i, embedding in zip(misses, miss_embeddings):
+        embeddings[i] = embedding
+        self.cache.put(queries[i], embedding)
+    return embeddings
+
+
+class RerankCache():
+  # Thread-safe LRU cache of reranker scores keyed by (query hash, chunk id)
+  # The chunk id is the vectordb row id, which is never reused, and entries are invalidated when their chunk is removed
+  def __init__(self, max_entries: int=100000):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.keys_by_chunk = dict() # Chunk id -> cached keys for the chunk, for invalidation
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def query_hash(query: str):
+    return hashlib.sha1(query.encode()).hexdigest()
+
+  def get_many(self, queries: list, chunk_ids: list):
+    # Returns the cached score of each (query, chunk id) pair, or None for a miss
+    keys = [(self.query_hash(query), chunk_id) for query, chunk_id in zip(queries, chunk_ids)]
+    scores = []
+    with self.lock:
+      for key in keys:
+        score = self.entries.get(key)
+        if score is None:
+          self.misses += 1
+        else:
+          self.entries.move_to_end(key)
+          self.hits += 1
+        scores.append(score)
+    return scores
+
+  def put_many(self, queries: list, chunk_ids: list, scores: list):
+    keys = [(self.query_hash(query), chunk_id) for query, chunk_id in zip(queries, chunk_ids)]
+    with self.lock:
+      for key, score in zip(keys, scores):
+        self.entries[key] = score
+        self.entries.move_to_end(key)
+        self.keys_by_chunk.setdefault(key[1], set()).add(key)
+      while len(self.entries) > self.max_entries:
+        old_key, _ = self.entries.popitem(last=False)
+        chunk_keys = self.keys_by_chunk[old_key[1]]
+        chunk_keys.discard(old_key)
+        if len(chunk_keys) == 0:
+          del self.keys_by_chunk[old_key[1]]
+    return
+
+  def invalidate(self, chunk_ids: list):
+    with self.lock:
+      for chunk_id in chunk_ids:
+        for key in self.keys_by_chunk.pop(chunk_id, set()):
+          self.entries.pop(key, None)
+    return
+
+  def stats(self):
+    with self.lock:
+      return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "max_entries": self.max_entries}
+
 
 class RerankerModel():
-  def __init__(self):
-    self.reranker = FlagReranker('BAAI/bge-reranker-base',
-                                 use_fp16=True)
+  model_str = 'BAAI/bge-reranker-base'
+  def __init__(self, cache_entries: int=100000, backend: str="flag", lazy: bool=False):
+    if backend not in inference_backends:
+      raise ValueError(f"Invalid inference backend: {backend}. Choose from {', '.join(inference_backends)}.")
+    self.backend = backend
+    # With lazy=True the weights are loaded by load(), on first use or by the background startup of the server
+    self.reranker = None
+    self.load_lock = threading.Lock()
+    if not lazy:
+      self.load()
+    self.cache = RerankCache(cache_entries) if cache_entries > 0 else None
+
+  def load(self):
+    # Returns the model, loading it if it is not loaded yet
+    with self.load_lock:
+      if self.reranker is None:
+        self.reranker = inference_backends[self.backend](FlagReranker, self.model_str)
+    return self.reranker
+
+  def warm_up(self):
+    # Loads the model and scores a pair so that the first request does not pay for CUDA initialization
+    self.load().compute_score([["warm up", "warm up"]])
+    return
                                  
   def compute_score(self, query_doc_pairs):
-    scores = self.reranker.compute_score(query_doc_pairs)
+    scores = (self.reranker or self.load()).compute_score(query_doc_pairs)
+    # FlagReranker returns a float instead of a list for a single pair
+    if not isinstance(scores, list):
+      scores = [scores]
     return scores
+
+  def score(self, query: str, docs: list, chunk_ids: list):
+    # Scores the docs for the query, only the pairs missing from the cache are sent to the model
+    return self.score_pairs([query] * len(docs), docs, chunk_ids)
+
+  def score_pairs(self, queries: list, docs: list, chunk_ids: list):
+    # Scores each (query, doc) pair, the cache misses of all queries go to the model in one batch
+    if len(docs) == 0:
+      return []
+    if self.cache is None:
+      return self.compute_score([[query, doc] for query, doc in zip(queries, docs)])
+    scores = self.cache.get_many(queries, chunk_ids)
+    misses = [i for i, score in enumerate(scores) if score is None]
+    if len(misses) > 0:
+      miss_scores = self.compute_score([[queries[i], docs[i]] for i in misses])
+      for i, score in zip(misses, miss_scores):
+        scores[i] = score
+      self.cache.put_many([queries[i] for i in misses], [chunk_ids[i] for i in misses], miss_scores)
+    return scores
+
+  def invalidate(self, chunk_ids: list):
+    if self.cache is not None:
+      self.cache.invalidate(chunk_ids)
+    return
   
 
-embedding_model = EmbeddingModel()
-reranker = RerankerModel()
\ No newline at end of file
+# Threads torch uses for CPU inference, 0 keeps the torch default of one per core
+inference_threads = int(os.getenv("INFERENCE_THREADS", "0"))
+if inference_threads > 0:
+  torch.set_num_threads(inference_threads)
+
+# The weights are loaded in the background when the server starts, see startup.py
+embedding_model = EmbeddingModel(cache_bytes=int(os.getenv("EMBEDDING_CACHE_BYTES", str(64 * 1024 * 1024))), backend=os.getenv("EMBEDDING_BACKEND", "flag"), lazy=True)
+reranker = RerankerModel(cache_entries=int(os.getenv("RERANK_CACHE_ENTRIES", "100000")), backend=os.getenv("RERANKER_BACKEND", "flag"), lazy=True)
\ No newline at end of file
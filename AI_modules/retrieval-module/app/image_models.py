@@ -8,57 +8,89 @@ torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
 
 
 class ImageCaptionModel():
-  def __init__(self, model_str: str="microsoft/Florence-2-base-ft"):
+  def __init__(self, model_str: str="microsoft/Florence-2-base-ft", num_beams: int=3, max_new_tokens: int=1024, batch_size: int=8):
     self.model = AutoModelForCausalLM.from_pretrained(model_str, torch_dtype=torch_dtype, trust_remote_code=True).to(device)
     self.processor = AutoProcessor.from_pretrained(model_str, trust_remote_code=True)
+    self.num_beams = num_beams
+    self.max_new_tokens = max_new_tokens
+    self.batch_size = batch_size # Number of images in one generate call
+
+  def memory_footprint(self):
+    # Bytes used by the model weights
+    return sum(tensor.numel() * tensor.element_size() for tensor in list(self.model.parameters()) + list(self.model.buffers()))
 
   def predict(self, image, task_prompt, text_input=None):
+    return self.predict_batch([image], task_prompt, text_input)[0]
+
+  def predict_batch(self, images, task_prompt, text_input=None):
+    # Runs the task on all images in one padded generate call, returns one parsed answer (or None on error) per image
     if text_input is None:
         prompt = task_prompt
     else:
         prompt = task_prompt + text_input
     try:
-      inputs = self.processor(text=prompt, images=image, return_tensors="pt").to(device, torch_dtype)
+      # The prompt is the same for every image, so the batch needs no attention mask
+      inputs = self.processor(text=[prompt] * len(images), images=images, return_tensors="pt", padding=True).to(device, torch_dtype)
       generated_ids = self.model.generate(
-        input_ids=inputs["input_ids"].cuda(),
-        pixel_values=inputs["pixel_values"].cuda(),
-        max_new_tokens=1024,
+        input_ids=inputs["input_ids"],
+        pixel_values=inputs["pixel_values"],
+        max_new_tokens=self.max_new_tokens,
         early_stopping=False,
         do_sample=False,
-        num_beams=3,
+        num_beams=self.num_beams,
       )
-      generated_text = self.processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
-      parsed_answer = self.processor.post_process_generation(
-          generated_text, 
-          task=task_prompt, 
-          image_size=(image.width, image.height)
-      )
-      return parsed_answer
+      generated_texts = self.processor.batch_decode(generated_ids, skip_special_tokens=False)
+      parsed_answers = []
+      for image, generated_text in zip(images, generated_texts):
+        parsed_answers.append(self.processor.post_process_generation(
+            generated_text, 
+            task=task_prompt, 
+            image_size=(image.width, image.height)
+        ))
+      return parsed_answers
 
     except Exception as e:
       print("Error predicting")
       print(e)
-      return None
+      # Retry the images one by one so that one bad image does not fail the others in its batch
+      if len(images) > 1:
+        return [self.predict_batch([image], task_prompt, text_input)[0] for image in images]
+      return [None]
   
   def generate(self, file):
-    image = self.load_image(file)
+    return self.generate_batch([file])[0]
+
+  def generate_batch(self, files):
+    # Returns the text of each image, or None for an image that could not be loaded or read by either task
+    images = [self.load_image(file) for file in files]
+    loaded_positions = [i for i, image in enumerate(images) if image is not None]
+    results = [None] * len(images)
     # Use OCR
-    print("Using OCR")
-    ocr_result = self.predict(image, "<OCR>")["<OCR>"]
-    print("OCR result: ", ocr_result)
-    if ocr_result != "":
-      return ocr_result
+    print(f"Using OCR on {len(loaded_positions)} images")
+    for start in range(0, len(loaded_positions), self.batch_size):
+      positions = loaded_positions[start:start + self.batch_size]
+      answers = self.predict_batch([images[i] for i in positions], "<OCR>")
+      for i, answer in zip(positions, answers):
+        results[i] = answer["<OCR>"] if answer is not None else ""
+    print("OCR results: ", results)
 
-    # If OCR does not work, generate a detailed caption
-    print("Generating detailed caption")
-    caption = self.predict(image, "<MORE_DETAILED_CAPTION>")["<MORE_DETAILED_CAPION>"]
-    print("Caption: ", caption)
-    return caption
+    # If OCR does not work, generate a detailed caption, only for the images without text
+    caption_positions = [i for i in loaded_positions if results[i] == ""]
+    if len(caption_positions) > 0:
+      print(f"Generating detailed captions for {len(caption_positions)} images")
+    for start in range(0, len(caption_positions), self.batch_size):
+      positions = caption_positions[start:start + self.batch_size]
+      answers = self.predict_batch([images[i] for i in positions], "<MORE_DETAILED_CAPTION>")
+      for i, answer in zip(positions, answers):
+        results[i] = answer["<MORE_DETAILED_CAPTION>"] if answer is not None else None
+        print("Caption: ", results[i])
+    return results
   
   def load_image(self, file):
+    # Returns None if the file is not a readable image
     try:
-      img = Image.open(file).convert("RGB")
+      return Image.open(file).convert("RGB")
     except Exception as e:
       print("Error loading the image")
       print(e)
-    return img
\ No newline at end of file
+      return None
\ No newline at end of file
@@ -0,0 +1,87 @@
+import uuid
+import time
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueueFull(Exception):
+  pass
+
+
+class IngestionJobs():
+  # Runs uploads on a bounded pool of worker threads and keeps their progress for the /jobs/ endpoint
+  # Ingestion functions are called with a progress callback that receives the name of each completed stage
+  def __init__(self, max_workers: int=2, max_pending: int=32, max_finished: int=1000, metrics=None):
+    self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingestion")
+    self.max_pending = max_pending # Maximum number of queued or running jobs
+    self.max_finished = max_finished # Number of finished jobs kept for status queries
+    self.jobs = dict()
+    self.finished = deque()
+    self.pending = 0
+    self.running = 0
+    self.lock = threading.Lock()
+    self.metrics = metrics
+    if metrics is not None:
+      metrics.histogram("retrieval_ingestion_job_seconds", "Duration of ingestion jobs from start to finish, by outcome", ("status",))
+      metrics.register_collector(self.collect_metrics)
+
+
+  def submit(self, filename: str, ingest, *args, cleanup=None):
+    with self.lock:
+      if self.pending >= self.max_pending:
+        raise JobQueueFull(f"{self.pending} uploads are already being processed")
+      job_id = str(uuid.uuid4())
+      self.jobs[job_id] = {"id": job_id, "filename": filename, "status": "queued", "stage": None, "error": None,
+                           "created_at": datetime.now(timezone.utc), "finished_at": None}
+      self.pending += 1
+    self.executor.submit(self.run, job_id, ingest, args, cleanup)
+    return job_id
+
+
+  def update(self, job_id: str, **fields):
+    with self.lock:
+      self.jobs[job_id].update(fields)
+    return
+
+
+  def run(self, job_id: str, ingest, args, cleanup):
+    self.update(job_id, status="running")
+    with self.lock:
+      self.running += 1
+    start = time.perf_counter()
+    try:
+      ingest(*args, progress=lambda stage: self.update(job_id, stage=stage))
+      self.update(job_id, status="done", finished_at=datetime.now(timezone.utc))
+      print("Ingested: ", self.jobs[job_id]["filename"])
+    except Exception as e:
+      print("Error in ingesting: ", self.jobs[job_id]["filename"])
+      print(e)
+      self.update(job_id, status="failed", error=str(e), finished_at=datetime.now(timezone.utc))
+    finally:
+      if cleanup is not None:
+        cleanup()
+      if self.metrics is not None:
+        self.metrics.observe("retrieval_ingestion_job_seconds", (self.jobs[job_id]["status"],), time.perf_counter() - start)
+      with self.lock:
+        self.pending -= 1
+        self.running -= 1
+        # Forget the oldest finished jobs
+        self.finished.append(job_id)
+        while len(self.finished) > self.max_finished:
+          del self.jobs[self.finished.popleft()]
+    return
+
+
+  def collect_metrics(self):
+    with self.lock:
+      running = self.running
+      queued = self.pending - self.running
+    return [("retrieval_ingestion_jobs", "gauge", "Ingestion jobs waiting for a worker or being processed", [({"status": "queued"}, queued), ({"status": "running"}, running)])]
+
+
+  def get(self, job_id: str):
+    with self.lock:
+      job = self.jobs.get(job_id)
+      return dict(job) if job is not None else None
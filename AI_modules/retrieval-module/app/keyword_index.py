@@ -0,0 +1,273 @@
+import math
+import itertools
+import os
+import json
+from collections import Counter
+import numpy as np
+import bm25s
+
+
+class KeywordIndex():
+  # Incremental BM25 index (Lucene variant, same scoring as bm25s.BM25 defaults)
+  # Keeps the token ids of every chunk and the document frequency of every token so that
+  # adding or removing a file only touches the chunks of that file
+  # Postings are kept in compressed sparse row arrays, one row per token id, and the postings of new chunks in a small delta
+  # that is merged into the arrays once it grows past a fraction of them
+  # Removed chunks are masked out of the results until the next merge drops their postings, only then are their ids reused
+  def __init__(self, k1: float=1.5, b: float=0.75, stopwords: str="en", merge_fraction: float=0.125, min_merge_postings: int=65536):
+    self.k1 = k1
+    self.b = b
+    self.stopwords = stopwords
+    self.merge_fraction = merge_fraction # The delta is merged once it holds this fraction of the postings in the arrays
+    self.min_merge_postings = min_merge_postings # or at least this many postings
+    self.vocab = {} # Token string -> token id
+    self.doc_freqs = [] # Token id -> number of chunks containing the token
+    self.postings_offsets = np.zeros(1, dtype=np.int64) # Token id -> start of its postings, the arrays are replaced on merge and never modified
+    self.postings_chunks = np.zeros(0, dtype=np.int32) # Chunk ids of the postings of every token
+    self.postings_tfs = np.zeros(0, dtype=np.int32) # Term frequencies of the postings of every token
+    self.delta = {} # Token id -> ([chunk ids], [term frequencies]) of the postings added since the last merge
+    self.delta_postings = 0
+    self.removed_postings = 0 # Postings of removed chunks still in the arrays or the delta
+    self.chunk_tokens = [] # Chunk id -> array of token ids (None if the slot is free)
+    self.doc_lens = np.zeros(0, dtype=np.float64) # Chunk id -> number of tokens in the chunk
+    self.live = np.zeros(0, dtype=bool) # Chunk id -> whether the chunk is indexed
+    self.removed_ids = [] # Chunk ids that were removed and still have postings
+    self.free_ids = [] # Chunk ids that were removed and can be reused
+    self.num_chunks = 0
+    self.total_len = 0
+
+
+  def __len__(self):
+    return self.num_chunks
+
+
+  def vocabulary_size(self):
+    # Number of tokens found in at least one chunk
+    return sum(1 for doc_freq in self.doc_freqs if doc_freq > 0)
+
+
+  def tokenize(self, texts: list):
+    return bm25s.tokenize(texts, stopwords=self.stopwords, return_ids=False, show_progress=False)
+
+
+  def _next_id(self):
+    if len(self.free_ids) > 0:
+      return self.free_ids.pop()
+    chunk_id = len(self.chunk_tokens)
+    self.chunk_tokens.append(None)
+    if chunk_id >= len(self.doc_lens):
+      # Grow the length arrays geometrically to avoid reallocating on every chunk
+      size = max(16, 2 * len(self.doc_lens))
+      doc_lens = np.zeros(size, dtype=np.float64)
+      doc_lens[:len(self.doc_lens)] = self.doc_lens
+      self.doc_lens = doc_lens
+      live = np.zeros(size, dtype=bool)
+      live[:len(self.live)] = self.live
+      self.live = live
+    return chunk_id
+
+
+  def _token_id(self, token: str):
+    token_id = self.vocab.get(token)
+    if token_id is None:
+      token_id = len(self.doc_freqs)
+      self.vocab[token] = token_id
+      self.doc_freqs.append(0)
+    return token_id
+
+
+  def add(self, texts: list):
+    # Tokenize only the new chunks and update the statistics, returns the chunk ids
+    chunk_ids = []
+    for tokens in self.tokenize(texts):
+      chunk_id = self._next_id()
+      token_ids = np.array([self._token_id(token) for token in tokens], dtype=np.int32)
+      for token_id, tf in Counter(token_ids.tolist()).items():
+        self.doc_freqs[token_id] += 1
+        postings = self.delta.setdefault(token_id, ([], []))
+        postings[0].append(chunk_id)
+        postings[1].append(tf)
+        self.delta_postings += 1
+      self.chunk_tokens[chunk_id] = token_ids
+      self.doc_lens[chunk_id] = len(token_ids)
+      self.live[chunk_id] = True
+      self.num_chunks += 1
+      self.total_len += len(token_ids)
+      chunk_ids.append(chunk_id)
+    self.maybe_merge()
+    return chunk_ids
+
+
+  def remove(self, chunk_ids: list):
+    for chunk_id in chunk_ids:
+      token_ids = self.chunk_tokens[chunk_id]
+      if token_ids is None:
+        continue
+      unique_token_ids = set(token_ids.tolist())
+      for token_id in unique_token_ids:
+        self.doc_freqs[token_id] -= 1
+      self.chunk_tokens[chunk_id] = None
+      self.doc_lens[chunk_id] = 0
+      self.live[chunk_id] = False
+      self.num_chunks -= 1
+      self.total_len -= len(token_ids)
+      # The postings of the chunk are dropped on the next merge
+      self.removed_ids.append(chunk_id)
+      self.removed_postings += len(unique_token_ids)
+    self.maybe_merge()
+    return
+
+
+  def maybe_merge(self):
+    if self.delta_postings + self.removed_postings >= max(self.min_merge_postings, self.merge_fraction * len(self.postings_chunks)):
+      self.merge()
+    return
+
+
+  def merge(self):
+    # Rebuild the postings arrays with the delta and without the postings of removed chunks
+    if self.delta_postings == 0 and len(self.removed_ids) == 0:
+      return
+    num_tokens = len(self.doc_freqs)
+    chunks = self.postings_chunks
+    tfs = self.postings_tfs
+    counts = np.diff(self.postings_offsets)
+    if len(self.removed_ids) > 0:
+      keep = self.live[chunks]
+      counts = np.bincount(np.repeat(np.arange(len(counts), dtype=np.int32), counts)[keep], minlength=len(counts))
+      chunks, tfs = chunks[keep], tfs[keep]
+    counts = np.concatenate([counts, np.zeros(num_tokens - len(counts), dtype=np.int64)])
+    delta_tokens = np.repeat(np.fromiter(self.delta.keys(), dtype=np.int32, count=len(self.delta)),
+                             np.fromiter((len(chunk_ids) for chunk_ids, token_tfs in self.delta.values()), dtype=np.int64, count=len(self.delta)))
+    delta_chunks = np.fromiter(itertools.chain.from_iterable(chunk_ids for chunk_ids, token_tfs in self.delta.values()), dtype=np.int32, count=self.delta_postings)
+    delta_tfs = np.fromiter(itertools.chain.from_iterable(token_tfs for chunk_ids, token_tfs in self.delta.values()), dtype=np.int32, count=self.delta_postings)
+    keep = self.live[delta_chunks]
+    delta_tokens, delta_chunks, delta_tfs = delta_tokens[keep], delta_chunks[keep], delta_tfs[keep]
+    # The postings of the delta go after the postings of the same token in the arrays, which are only copied once
+    order = np.argsort(delta_tokens, kind="stable")
+    positions = np.cumsum(counts)[delta_tokens[order]]
+    self.postings_chunks = np.insert(chunks, positions, delta_chunks[order])
+    self.postings_tfs = np.insert(tfs, positions, delta_tfs[order])
+    postings_offsets = np.zeros(num_tokens + 1, dtype=np.int64)
+    np.cumsum(counts + np.bincount(delta_tokens, minlength=num_tokens), out=postings_offsets[1:])
+    self.postings_offsets = postings_offsets
+    self.delta = {}
+    self.delta_postings = 0
+    self.removed_postings = 0
+    self.free_ids.extend(self.removed_ids)
+    self.removed_ids = []
+    return
+
+
+  def postings(self, token_id: int):
+    # Chunk ids and term frequencies of the chunks containing the token, including removed chunks not merged yet
+    if token_id < len(self.postings_offsets) - 1:
+      start, end = self.postings_offsets[token_id], self.postings_offsets[token_id + 1]
+      chunk_ids, tfs = self.postings_chunks[start:end], self.postings_tfs[start:end]
+    else:
+      chunk_ids, tfs = self.postings_chunks[:0], self.postings_tfs[:0]
+    delta = self.delta.get(token_id)
+    if delta is not None:
+      chunk_ids = np.concatenate([chunk_ids, np.array(delta[0], dtype=np.int32)])
+      tfs = np.concatenate([tfs, np.array(delta[1], dtype=np.int32)])
+    return chunk_ids, tfs
+
+
+  def get_scores(self, query_tokens: list):
+    # Returns the BM25 score of every chunk id for the tokenized query
+    scores = np.zeros(len(self.chunk_tokens), dtype=np.float64)
+    if self.num_chunks == 0:
+      return scores
+    avg_doc_len = self.total_len / self.num_chunks
+    for token in query_tokens:
+      token_id = self.vocab.get(token)
+      if token_id is None or self.doc_freqs[token_id] == 0:
+        continue
+      df = self.doc_freqs[token_id]
+      idf = math.log(1 + (self.num_chunks - df + 0.5) / (df + 0.5))
+      ids, tfs = self.postings(token_id)
+      l_d = self.doc_lens[ids]
+      scores[ids] += idf * tfs / (self.k1 * ((1 - self.b) + self.b * l_d / avg_doc_len) + tfs)
+    return scores
+
+
+  def retrieve(self, query: str, k: int=3):
+    # Returns the chunk ids and scores of the top-k chunks for the query
+    return self.retrieve_batch([query], k)[0]
+
+
+  def retrieve_batch(self, queries: list, k: int=3):
+    # Tokenizes all queries together, returns (chunk ids, scores) of the top-k chunks for each query
+    return self.retrieve_tokens_batch(self.tokenize(queries), k)
+
+
+  def retrieve_tokens_batch(self, query_tokens_list: list, k: int=3):
+    # Same as retrieve_batch for queries that are already tokenized
+    k = min(k, self.num_chunks)
+    if k < 1:
+      return [([], []) for _ in query_tokens_list]
+    results = []
+    for query_tokens in query_tokens_list:
+      scores = self.get_scores(query_tokens)
+      # Free slots and removed chunks can never be returned
+      scores[~self.live[:len(scores)]] = -np.inf
+      top_ids = np.argpartition(-scores, k - 1)[:k]
+      top_ids = top_ids[np.argsort(-scores[top_ids], kind="stable")]
+      results.append((top_ids.tolist(), scores[top_ids].tolist()))
+    return results
+
+
+  def save(self, path: str):
+    # Save the index as flat .npy arrays (loadable with memory mapping) and a json vocabulary
+    self.save_arrays(path, *self.to_arrays())
+    return
+
+
+  def to_arrays(self):
+    # Copies the index into the arrays and vocabulary written by save_arrays, which can then run without holding the index
+    # The postings arrays are merged first and are never modified afterwards, so they are returned without copying
+    self.merge()
+    lens = np.array([len(tokens) if tokens is not None else -1 for tokens in self.chunk_tokens], dtype=np.int64)
+    token_offsets = np.zeros(len(lens) + 1, dtype=np.int64)
+    np.cumsum(np.maximum(lens, 0), out=token_offsets[1:])
+    live_tokens = [tokens for tokens in self.chunk_tokens if tokens is not None]
+    token_ids = np.concatenate(live_tokens) if len(live_tokens) > 0 else np.zeros(0, dtype=np.int32)
+    arrays = {"chunk_lens": lens, "token_offsets": token_offsets, "token_ids": token_ids.astype(np.int32),
+              "postings_offsets": self.postings_offsets, "postings_chunks": self.postings_chunks, "postings_tfs": self.postings_tfs}
+    vocab = {"k1": self.k1, "b": self.b, "stopwords": self.stopwords, "vocab": sorted(self.vocab, key=self.vocab.get)}
+    return arrays, vocab
+
+
+  @staticmethod
+  def save_arrays(path: str, arrays: dict, vocab: dict):
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+      np.save(os.path.join(path, f"{name}.npy"), array)
+    with open(os.path.join(path, "vocab.json"), "w") as f:
+      json.dump(vocab, f)
+    return
+
+
+  @classmethod
+  def load(cls, path: str, mmap: bool=True):
+    # Chunk token ids and postings stay memory mapped, snapshots are written to a new directory so the mapped files are never modified
+    mmap_mode = "r" if mmap else None
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+              for name in ["chunk_lens", "token_offsets", "token_ids", "postings_offsets", "postings_chunks", "postings_tfs"]}
+    with open(os.path.join(path, "vocab.json")) as f:
+      meta = json.load(f)
+    index = cls(k1=meta["k1"], b=meta["b"], stopwords=meta["stopwords"])
+    index.vocab = {token: token_id for token_id, token in enumerate(meta["vocab"])}
+    lens = np.asarray(arrays["chunk_lens"])
+    token_offsets = arrays["token_offsets"]
+    index.chunk_tokens = [arrays["token_ids"][token_offsets[i]:token_offsets[i + 1]] if lens[i] >= 0 else None for i in range(len(lens))]
+    index.doc_lens = np.maximum(lens, 0).astype(np.float64)
+    index.live = lens >= 0
+    index.free_ids = np.flatnonzero(lens < 0).tolist()
+    index.num_chunks = int((lens >= 0).sum())
+    index.total_len = int(np.maximum(lens, 0).sum())
+    index.postings_offsets = np.asarray(arrays["postings_offsets"])
+    index.postings_chunks = arrays["postings_chunks"]
+    index.postings_tfs = arrays["postings_tfs"]
+    index.doc_freqs = np.diff(index.postings_offsets).tolist()
+    return index
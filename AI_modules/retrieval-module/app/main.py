@@ -1,14 +1,43 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends
+from fastapi.responses import PlainTextResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 import uvicorn
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Literal
+from datetime import datetime
+from embedding_models import embedding_model, reranker
 from retrieval_model import hybrid_search
+from document_parser import document_parser
+from ingestion_jobs import IngestionJobs, JobQueueFull
+from metrics import metrics
+from startup import Startup
+import io
 import os
+import uuid
+import hashlib
 
 
-app = FastAPI()
+# Models and the search index load concurrently in the background, the server accepts requests meanwhile
+startup = Startup({"embedding_model": embedding_model.warm_up, "reranker": reranker.warm_up, "search_index": hybrid_search.start}, metrics=metrics)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  startup.start()
+  yield
+  # Save the keyword index on shutdown so that the next start does not rebuild it
+  hybrid_search.save_snapshot()
+  document_parser.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+# Uploads are processed in the background by a bounded pool of workers
+ingestion_jobs = IngestionJobs(max_workers=int(os.getenv("INGESTION_WORKERS", "2")), max_pending=int(os.getenv("INGESTION_MAX_PENDING", "32")), metrics=metrics)
+metrics.histogram("retrieval_request_seconds", "Latency of the retrieval endpoints", ("endpoint",))
+
+image_types = ["image/jpeg", "image/png"]
+Chunker = Literal["character", "token", "markdown"] # Names of the chunkers in chunkers.chunkers
+upload_chunk_size = 1024 * 1024
 
 origins = ["*"]
 
@@ -20,6 +49,11 @@ app.add_middleware(
   allow_headers=["*"],
 )
 
+def require_ready():
+  # Endpoints that use the models or the search index answer 503 until they are loaded
+  if not startup.ready():
+    raise HTTPException(status_code=503, detail="Retrieval module is starting, try again later", headers={"Retry-After": "5"})
+
 class FileSize(BaseModel):
   id: str
   name: str
@@ -31,54 +65,158 @@ class FileList(BaseModel):
 class RetrievalQuery(BaseModel):
   query: str
   k: Optional[int] = 3
+  mode: Literal["rerank", "rrf", "auto"] = "rerank" # rrf skips the reranker, auto reranks only ambiguous rankings
 
 class RetrievalDoc(BaseModel):
   docs: List[str]
   filenames: List[str]
 
+class BatchRetrievalQuery(BaseModel):
+  queries: List[str]
+  k: Optional[int] = 3
+  mode: Literal["rerank", "rrf", "auto"] = "rerank"
+
+class BatchRetrievalDoc(BaseModel):
+  results: List[RetrievalDoc]
+
+class IngestionJob(BaseModel):
+  id: str
+  filename: str
+  status: str # queued, running, done or failed
+  stage: Optional[str] = None # Last completed stage: parsed, chunked, embedded or indexed, preceded by reused if the chunks of an earlier upload with the same content and chunker were reused
+  error: Optional[str] = None
+  created_at: datetime
+  finished_at: Optional[datetime] = None
+
 
 @app.get("/")
 def read_root():
   return {"Server": "On"}
 
-@app.get("/load/")
+@app.get("/health")
+def health_check():
+  # Liveness, the server is up unless a component failed to load
+  if startup.failed():
+    return JSONResponse(status_code=503, content={"status": "failed", "components": startup.stats()})
+  return {"status": "healthy"}
+
+@app.get("/ready")
+def ready_check():
+  # Readiness, the models are loaded and the search index is built
+  if not startup.ready():
+    return JSONResponse(status_code=503, content={"status": "starting", "components": startup.stats()})
+  return {"status": "ready", "components": startup.stats()}
+
+@app.get("/load/", dependencies=[Depends(require_ready)])
 def load_files():
   filesizes = hybrid_search.load_files()
   return FileList(filesizes=filesizes)
 
-@app.post("/upload/")
-async def upload_document(file: UploadFile):
+async def save_upload(file: UploadFile):
+  # Copy the upload to a temp file a chunk at a time so that large documents are never held in memory
+  # Returns the path and the content hash used to detect re-uploads
+  os.makedirs("temp", exist_ok=True)
+  # Prefix the temp file so that concurrent uploads with the same name do not collide
+  path = f"temp/{uuid.uuid4()}_{file.filename}"
+  content_hash = hashlib.sha256()
+  with open(path, "wb") as temp_file:
+    while chunk := await file.read(upload_chunk_size):
+      content_hash.update(chunk)
+      temp_file.write(chunk)
+  return path, content_hash.hexdigest()
+
+async def submit_upload(file: UploadFile, chunker=None):
+  # The upload is only saved here, parsing, embedding and indexing run as a background job
   if file.content_type in ["application/pdf", "text/plain"]:
-    await hybrid_search.add_text_document(file, file.filename)
+    path, file_hash = await save_upload(file)
+    # Delete the temp_file after use
+    try:
+      job_id = ingestion_jobs.submit(file.filename, hybrid_search.add_text_document, path, file.filename,
+                                     "pdf" if file.content_type == "application/pdf" else "txt", file_hash, chunker, cleanup=lambda: os.remove(path))
+    except JobQueueFull:
+      os.remove(path)
+      raise
     print(f'{"PDF" if file.content_type == "application/pdf" else "Text"} Uploaded: {file.filename}')
-  elif file.content_type in ["image/jpeg", "image/png"]:
-    hybrid_search.add_image(file.file, file.filename)
+  elif file.content_type in image_types:
+    image_content = await file.read()
+    job_id = ingestion_jobs.submit(file.filename, hybrid_search.add_image, io.BytesIO(image_content), file.filename, hashlib.sha256(image_content).hexdigest(), chunker)
     print("Image Uploaded: ", file.filename)
   elif file.content_type == "audio/mpeg":
-    os.makedirs("temp", exist_ok=True)
-    path = f"temp/{file.filename}"
-    with open(path, "wb") as temp_file:
-      temp_file.write(file.file.read())
-    hybrid_search.add_speech(path, file.filename)
+    path, file_hash = await save_upload(file)
     # Delete the temp_file after use
-    temp_file.close()
-    os.remove(path)
+    try:
+      job_id = ingestion_jobs.submit(file.filename, hybrid_search.add_speech, path, file.filename, file_hash, chunker, cleanup=lambda: os.remove(path))
+    except JobQueueFull:
+      os.remove(path)
+      raise
     print("Speech Uploaded: ", file.filename)
   else:
     raise HTTPException(status_code=404, detail="Only PDF/JPG/PNG/MP3 files are accepted!")
-  return 
-
-@app.delete("/remove/{file_id}/")
+  return job_id
+
+@app.post("/upload/", dependencies=[Depends(require_ready)])
+async def upload_document(file: UploadFile, chunker: Optional[Chunker] = Form(None)) -> IngestionJob:
+  # chunker selects how the document is split, the server default is used if it is not given
+  try:
+    job_id = await submit_upload(file, chunker)
+  except JobQueueFull as e:
+    raise HTTPException(status_code=503, detail=f"Too many uploads in progress, try again later: {e}")
+  return IngestionJob(**ingestion_jobs.get(job_id))
+
+@app.post("/upload_multiple/", dependencies=[Depends(require_ready)])
+async def upload_documents(files: List[UploadFile], chunker: Optional[Chunker] = Form(None)) -> List[IngestionJob]:
+  # Images are captioned together in one job, other files get a job each
+  unsupported = [file.filename for file in files if file.content_type not in ["application/pdf", "text/plain", "audio/mpeg"] + image_types]
+  if len(unsupported) > 0:
+    raise HTTPException(status_code=404, detail=f"Only PDF/JPG/PNG/MP3 files are accepted! Rejected: {', '.join(unsupported)}")
+  job_ids = []
+  try:
+    images = [file for file in files if file.content_type in image_types]
+    if len(images) > 0:
+      image_contents = [await file.read() for file in images]
+      image_filenames = [file.filename for file in images]
+      job_ids.append(ingestion_jobs.submit(", ".join(image_filenames), hybrid_search.add_images, [io.BytesIO(content) for content in image_contents], image_filenames,
+                                           [hashlib.sha256(content).hexdigest() for content in image_contents], chunker))
+      print(f"{len(images)} Images Uploaded: {image_filenames}")
+    for file in files:
+      if file.content_type not in image_types:
+        job_ids.append(await submit_upload(file, chunker))
+  except JobQueueFull as e:
+    # Files submitted before the queue filled up are still processed
+    raise HTTPException(status_code=503, detail=f"Too many uploads in progress, only {len(job_ids)} jobs were started, try again later: {e}")
+  return [IngestionJob(**ingestion_jobs.get(job_id)) for job_id in job_ids]
+
+@app.get("/jobs/{job_id}/")
+def get_job(job_id: str) -> IngestionJob:
+  job = ingestion_jobs.get(job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail="Job not found!")
+  return IngestionJob(**job)
+
+@app.delete("/remove/{file_id}/", dependencies=[Depends(require_ready)])
 def remove_document(file_id: str):
   hybrid_search.remove_documents(file_id)
   print("Removed: ", file_id)
   return
 
-@app.post("/retrieve/")
+@app.post("/retrieve/", dependencies=[Depends(require_ready)])
 def retrieve_documents(retrieval_query: RetrievalQuery) -> RetrievalDoc:
-  reranked_docs, all_filenames = hybrid_search.search(retrieval_query.query, retrieval_query.k)
+  with metrics.timer("retrieval_request_seconds", ("/retrieve/",)):
+    reranked_docs, all_filenames = hybrid_search.search(retrieval_query.query, retrieval_query.k, retrieval_query.mode)
   return RetrievalDoc(docs=reranked_docs, filenames=list(all_filenames))
 
+@app.post("/retrieve_batch/", dependencies=[Depends(require_ready)])
+def retrieve_documents_batch(batch_retrieval_query: BatchRetrievalQuery) -> BatchRetrievalDoc:
+  # Results are returned in the order of the queries
+  with metrics.timer("retrieval_request_seconds", ("/retrieve_batch/",)):
+    results = hybrid_search.search_batch(batch_retrieval_query.queries, batch_retrieval_query.k, batch_retrieval_query.mode)
+  return BatchRetrievalDoc(results=[RetrievalDoc(docs=reranked_docs, filenames=list(all_filenames)) for reranked_docs, all_filenames in results])
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+  # Prometheus text exposition format
+  return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 
 if __name__ == '__main__':
   uvicorn.run(app, port=8000, host='0.0.0.0')
\ No newline at end of file
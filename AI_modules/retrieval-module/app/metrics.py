@@ -0,0 +1,120 @@
+import bisect
+import time
+import threading
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds of the latency histogram buckets
+latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+def escape_label(value):
+  return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple, bucket=None):
+  # Renders {name="value",...}, with the le label of a histogram bucket if bucket is given
+  labels = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+  if bucket is not None:
+    labels.append(f'le="{bucket}"')
+  return "{" + ",".join(labels) + "}" if len(labels) > 0 else ""
+
+
+def format_value(value):
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics():
+  # Histograms and counters of the retrieval module, rendered in the Prometheus text format by the /metrics endpoint
+  # Gauges are read from collectors at every scrape, a collector returns [(name, type, help, [(label dict, value), ...]), ...]
+  def __init__(self, buckets: list=latency_buckets):
+    self.buckets = buckets
+    self.histograms = {} # Name -> (help, label names, {label values: [bucket counts, sum, count]})
+    self.counters = {} # Name -> (help, label names, {label values: value})
+    self.collectors = []
+    self.lock = threading.Lock()
+
+
+  def histogram(self, name: str, help: str, labels: tuple=()):
+    with self.lock:
+      self.histograms.setdefault(name, (help, labels, {}))
+    return
+
+
+  def counter(self, name: str, help: str, labels: tuple=()):
+    with self.lock:
+      self.counters.setdefault(name, (help, labels, {}))
+    return
+
+
+  def register_collector(self, collector):
+    with self.lock:
+      self.collectors.append(collector)
+    return
+
+
+  def observe(self, name: str, labels: tuple, seconds: float):
+    with self.lock:
+      series = self.histograms[name][2].setdefault(labels, [[0] * len(self.buckets), 0.0, 0])
+      bucket = bisect.bisect_left(self.buckets, seconds)
+      if bucket < len(self.buckets):
+        series[0][bucket] += 1
+      series[1] += seconds
+      series[2] += 1
+    return
+
+
+  @contextmanager
+  def timer(self, name: str, labels: tuple):
+    # Observes the duration of the block, also if it raises
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, labels, time.perf_counter() - start)
+
+
+  def inc(self, name: str, labels: tuple, amount: float=1):
+    with self.lock:
+      values = self.counters[name][2]
+      values[labels] = values.get(labels, 0) + amount
+    return
+
+
+  def render(self):
+    lines = []
+    with self.lock:
+      for name, (help, label_names, series) in self.histograms.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} histogram")
+        for label_values, (bucket_counts, total, count) in series.items():
+          cumulative = 0
+          for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{format_labels(label_names, label_values, bound)} {cumulative}")
+          lines.append(f"{name}_bucket{format_labels(label_names, label_values, '+Inf')} {count}")
+          lines.append(f"{name}_sum{format_labels(label_names, label_values)} {format_value(total)}")
+          lines.append(f"{name}_count{format_labels(label_names, label_values)} {count}")
+      for name, (help, label_names, values) in self.counters.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} counter")
+        for label_values, value in values.items():
+          lines.append(f"{name}{format_labels(label_names, label_values)} {format_value(value)}")
+      collectors = list(self.collectors)
+    # Collectors take their own locks, so they run outside of the metrics lock
+    for collector in collectors:
+      try:
+        families = collector()
+      except Exception as e:
+        print("Error in collecting metrics")
+        print(e)
+        continue
+      for name, metric_type, help, samples in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+          lines.append(f"{name}{format_labels(tuple(labels), tuple(labels.values()))} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
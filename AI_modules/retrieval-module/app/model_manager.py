@@ -0,0 +1,134 @@
+import os
+import gc
+import time
+import threading
+from contextlib import contextmanager
+import torch
+from image_models import ImageCaptionModel
+from speech_models import SpeechRecognitionModel
+
+
+class ModelManager():
+  # Keeps models loaded after their first use instead of reloading them for every upload
+  # A model is evicted once it has been idle for idle_timeout seconds, or when loading another model
+  # would exceed memory_budget bytes (least recently used first, 0 for no budget)
+  def __init__(self, idle_timeout: float=300, memory_budget: int=0, check_interval: float=30):
+    self.idle_timeout = idle_timeout
+    self.memory_budget = memory_budget
+    self.check_interval = check_interval
+    self.loaders = {} # Model name -> function that loads the model
+    self.models = {} # Model name -> loaded model
+    self.sizes = {} # Model name -> bytes used by the model the last time it was loaded
+    self.last_used = {} # Model name -> time the model was last released
+    self.use_locks = {} # Model name -> lock held while the model is in use
+    self.lock = threading.Lock()
+    self.loads = 0
+    self.evictions = 0
+    self.stopped = threading.Event()
+    self.evict_thread = threading.Thread(target=self.run_idle_eviction, daemon=True)
+    self.evict_thread.start()
+
+
+  def register(self, name: str, loader):
+    self.loaders[name] = loader
+    self.use_locks[name] = threading.Lock()
+    return
+
+
+  def memory_used(self):
+    return sum(self.sizes.get(name, 0) for name in self.models)
+
+
+  @contextmanager
+  def use(self, name: str):
+    # Yields the loaded model, one caller uses a model at a time
+    with self.use_locks[name]:
+      with self.lock:
+        model = self.models.get(name)
+      if model is None:
+        model = self.load(name)
+      try:
+        yield model
+      finally:
+        with self.lock:
+          self.last_used[name] = time.monotonic()
+    # Models that could not be evicted while in use may have left the budget exceeded
+    self.evict_for_budget(name, 0)
+
+
+  def load(self, name: str):
+    # Make room for the model if its size is known from an earlier load
+    self.evict_for_budget(name, self.sizes.get(name, 0))
+    start = time.perf_counter()
+    model = self.loaders[name]()
+    with self.lock:
+      self.models[name] = model
+      self.sizes[name] = model.memory_footprint()
+      self.loads += 1
+    print(f"Loaded model {name} ({self.sizes[name] / 2**20:.0f} MiB) in {time.perf_counter() - start:.1f} s")
+    self.evict_for_budget(name, 0)
+    return model
+
+
+  def evict_for_budget(self, name: str, size: int):
+    # Evict idle models other than name, least recently used first, until size more bytes fit in the budget
+    if self.memory_budget <= 0:
+      return
+    with self.lock:
+      candidates = sorted([other for other in self.models if other != name], key=lambda other: self.last_used.get(other, 0))
+    for other in candidates:
+      if self.memory_used() + size <= self.memory_budget:
+        break
+      self.evict(other, "memory budget")
+    return
+
+
+  def evict(self, name: str, reason: str):
+    # Models that are in use are skipped
+    if not self.use_locks[name].acquire(blocking=False):
+      return False
+    try:
+      with self.lock:
+        model = self.models.pop(name, None)
+        if model is None:
+          return False
+        self.evictions += 1
+      del model
+      gc.collect()
+      torch.cuda.empty_cache()
+      print(f"Evicted model {name} ({reason})")
+    finally:
+      self.use_locks[name].release()
+    return True
+
+
+  def evict_idle(self):
+    now = time.monotonic()
+    with self.lock:
+      idle = [name for name in self.models if now - self.last_used.get(name, now) >= self.idle_timeout]
+    for name in idle:
+      self.evict(name, f"idle for {self.idle_timeout:.0f} s")
+    return
+
+
+  def run_idle_eviction(self):
+    while not self.stopped.wait(self.check_interval):
+      try:
+        self.evict_idle()
+      except Exception as e:
+        print("Error evicting idle models")
+        print(e)
+
+
+  def stats(self):
+    with self.lock:
+      return {"loaded": sorted(self.models), "memory_used": self.memory_used(), "loads": self.loads, "evictions": self.evictions}
+
+
+model_manager = ModelManager(idle_timeout=float(os.getenv("MODEL_IDLE_TIMEOUT", "300")), memory_budget=int(os.getenv("MODEL_MEMORY_BUDGET_BYTES", "0")))
+model_manager.register("image_caption", lambda: ImageCaptionModel(num_beams=int(os.getenv("IMAGE_NUM_BEAMS", "3")), max_new_tokens=int(os.getenv("IMAGE_MAX_NEW_TOKENS", "1024")),
+                                                                 batch_size=int(os.getenv("IMAGE_BATCH_SIZE", "8"))))
+model_manager.register("speech_recognition", lambda: SpeechRecognitionModel(batch_size=int(os.getenv("SPEECH_BATCH_SIZE", "8")),
+                                                                           vad_threshold_db=float(os.getenv("VAD_THRESHOLD_DB", "-45")),
+                                                                           min_silence_seconds=float(os.getenv("VAD_MIN_SILENCE_SECONDS", "0.5")),
+                                                                           cut_search_seconds=float(os.getenv("VAD_CUT_SEARCH_SECONDS", "5"))))
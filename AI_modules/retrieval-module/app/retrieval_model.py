@@ -1,20 +1,63 @@
 import numpy as np
+import os
+import json
+import shutil
 import uuid
-import pymupdf
-import pymupdf4llm
-import bm25s
+import hashlib
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import psycopg
+from psycopg_pool import ConnectionPool
 from pgvector.psycopg import register_vector
-import torch
-import gc
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from embedding_models import embedding_model, reranker
-from image_models import ImageCaptionModel
-from speech_models import SpeechRecognitionModel
+from model_manager import model_manager
+from document_parser import document_parser
+from chunkers import chunkers
+from keyword_index import KeywordIndex
+from metrics import Metrics, metrics
+
+
+search_modes = ["rerank", "rrf", "auto"] # Cross-encoder reranking, reciprocal rank fusion only, or rerank only when the fused ranking is ambiguous
+
+# Distance operator and index operator class (without its vector type prefix) for each distance metric
+# bge embeddings are normalized, so inner product and cosine give the same ranking as L2
+vector_distances = {
+  "ip": ("<#>", "ip_ops"),
+  "cosine": ("<=>", "cosine_ops"),
+  "l2": ("<->", "l2_ops"),
+}
+
+# Column types of the embeddings: float32 (3 KB per 768-dimensional embedding) or float16 (1.5 KB)
+vector_types = ["vector", "halfvec"]
+
+# Quantization of the ANN index: none indexes the embeddings, binary indexes their sign bits (96 bytes per embedding)
+# and searches a shortlist by Hamming distance that is re-scored with the exact distance
+vector_quantizations = ["none", "binary"]
+
+# The vector search de-duplicates texts over a shortlist of shortlist_factor * k rows, widened by the same factor when it holds fewer than k texts
+shortlist_factor = 4
+max_ef_search = 1000 # Largest hnsw.ef_search accepted by pgvector
+
+
+def text_hash(text: str):
+  # Fingerprint of a chunk, chunks with the same text share their embedding
+  return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def timed(fn, *args, **kwargs):
+  # Returns the result of fn and its duration in milliseconds
+  start = time.perf_counter()
+  result = fn(*args, **kwargs)
+  return result, (time.perf_counter() - start) * 1000
 
 
 class HybridSearch:
-  def __init__(self, embedding_model, embedding_dim, reranker, host="db", port="5432", dbname="database", user="postgres", password="admin", corpus_dict=dict()):
+  def __init__(self, embedding_model, embedding_dim, reranker, host="db", port="5432", dbname="database", user="postgres", password="admin", corpus_dict=dict(),
+               vector_index="hnsw", vector_distance="ip", vector_type="vector", vector_quantization="none", rescore_factor=4,
+               hnsw_m=16, hnsw_ef_construction=64, ivfflat_lists=100, ef_search=40, probes=10,
+               pool_min_size=1, pool_max_size=10, snapshot_dir=None, snapshot_delay=60, search_threads=8, rrf_k=60, model_manager=None, document_parser=None, chunkers=None, default_chunker="character", embed_batch_size=64, page_batch_size=10,
+               metrics=None, lazy=False):
     self.embedding_model = embedding_model
     self.embedding_dim = embedding_dim
     self.reranker = reranker
@@ -23,107 +66,582 @@ class HybridSearch:
     self.dbname = dbname 
     self.user = user
     self.password = password
-    self.retriever = bm25s.BM25()
-    # Setup postgres
-    self.conn = psycopg.connect(f"host={self.host} port={self.port} dbname={self.dbname} user={self.user} password={self.password}")
-    self.conn.execute('CREATE EXTENSION IF NOT EXISTS vector')
-    register_vector(self.conn)
-    self.conn.commit()
-    self.conn.execute(f'CREATE TABLE IF NOT EXISTS vectordb (id SERIAL PRIMARY KEY, file_id text, embedding vector({self.embedding_dim}), filename text, text text, length integer)')
-    self.conn.commit()
+    self.pool_min_size = pool_min_size
+    self.pool_max_size = pool_max_size
+    if vector_index not in ["hnsw", "ivfflat", "none"]:
+      raise ValueError(f"Invalid vector index: {vector_index}. Choose from 'hnsw', 'ivfflat', 'none'.")
+    if vector_distance not in vector_distances:
+      raise ValueError(f"Invalid vector distance: {vector_distance}. Choose from {', '.join(vector_distances)}.")
+    if vector_type not in vector_types:
+      raise ValueError(f"Invalid vector type: {vector_type}. Choose from {', '.join(vector_types)}.")
+    if vector_quantization not in vector_quantizations:
+      raise ValueError(f"Invalid vector quantization: {vector_quantization}. Choose from {', '.join(vector_quantizations)}.")
+    self.vector_index = vector_index
+    self.vector_distance = vector_distance
+    self.vector_type = vector_type
+    self.vector_quantization = vector_quantization
+    self.rescore_factor = rescore_factor # With binary quantization, rows in the Hamming shortlist per row returned
+    self.distance_operator, operator_class = vector_distances[vector_distance]
+    self.operator_class = f"{vector_type}_{operator_class}"
+    self.hnsw_m = hnsw_m
+    self.hnsw_ef_construction = hnsw_ef_construction
+    self.ivfflat_lists = ivfflat_lists
+    self.ef_search = ef_search
+    self.probes = probes
+    self.vector_index_rows = 0 # Number of rows when the IVFFlat index was last built
+    self.vector_index_lock = threading.Lock() # Only one request rebuilds the IVFFlat index at a time
+    self.index_lock = threading.RLock() # Guards the keyword index and chunk arrays shared by the request threads
+    self.keyword_index = KeywordIndex()
+    self.model_manager = model_manager # Keeps the image caption and speech recognition models loaded between uploads
+    if chunkers is None or default_chunker not in chunkers:
+      raise ValueError(f"Invalid default chunker: {default_chunker}. Choose from {', '.join(chunkers or [])}.")
+    self.chunkers = chunkers # Chunker name -> chunker, selectable per upload
+    self.default_chunker = default_chunker
+    self.document_parser = document_parser # Converts uploaded documents to markdown in worker processes
+    self.embed_batch_size = embed_batch_size # Chunks embedded and inserted together during ingestion
+    self.page_batch_size = page_batch_size # Document pages converted to markdown together during ingestion
+    self.rrf_k = rrf_k # Rank offset of reciprocal rank fusion
+    # Stage timings and corpus statistics for the /metrics endpoint
+    self.metrics = metrics if metrics is not None else Metrics()
+    self.metrics.histogram("retrieval_search_stage_seconds", "Duration of each search stage, call is single for /retrieve/ and batch for a whole /retrieve_batch/ request", ("stage", "call"))
+    self.metrics.histogram("retrieval_ingestion_stage_seconds", "Time each ingested file spent in each ingestion stage", ("stage",))
+    self.metrics.counter("retrieval_ingested_chunks_total", "Ingested chunks, embedded by the model or reusing the embedding of a stored chunk with the same text", ("source",))
+    self.metrics.register_collector(self.collect_metrics)
+    self.search_executor = ThreadPoolExecutor(max_workers=search_threads, thread_name_prefix="search") # Runs the vector search stage alongside the keyword search
+    self.snapshot_dir = snapshot_dir # Directory of the keyword index snapshot, None disables snapshots
+    self.snapshot_delay = snapshot_delay # Seconds to wait after the last change before saving a snapshot
+    self.snapshot_timer = None
+    self.snapshot_lock = threading.Lock()
+    self.corpus_version = 0 # Version of the corpus in the keyword index, bumped in postgres on every change
+    self.changes_in_flight = 0 # Changes committed to postgres but not yet applied to the keyword index
     self.corpus_dict = corpus_dict # Dictonary of documents with id as key and texts as value
-    # Add to corpus_dict
-    length = self.conn.execute('SELECT COUNT(*) FROM vectordb').fetchone()[0]
-    if length > 0:
-      results = self.conn.execute('SELECT file_id, text FROM vectordb').fetchall()
-      for file_id, text in results:
-        if file_id not in self.corpus_dict:
+    self.chunk_ids = dict() # Dictionary of documents with id as key and BM25 chunk ids as value
+    self.chunk_texts = [] # Texts of the chunks indexed by BM25 chunk id
+    self.chunk_files = [] # [(file_id, filename, vectordb row id), ...] of every file containing the chunk, indexed by BM25 chunk id
+    self.text_chunks = dict() # Chunk text -> BM25 chunk id, chunks with the same text are indexed once
+    self.file_hashes = dict() # (content hash, chunker) -> ids of the files uploaded with that content and split by that chunker
+    self.pool = None
+    self.started = False # Set once postgres is set up and the keyword index is loaded
+    # With lazy=True the server calls start() in the background so that it can accept requests while the index loads
+    if not lazy:
+      self.start()
+
+
+  def start(self):
+    if self.started:
+      return
+    # Setup postgres
+    conninfo = f"host={self.host} port={self.port} dbname={self.dbname} user={self.user} password={self.password}"
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+      # The extension must exist before pooled connections register the vector type
+      conn.execute('CREATE EXTENSION IF NOT EXISTS vector')
+      if self.vector_type != "vector" or self.vector_quantization != "none":
+        # halfvec and binary_quantize need pgvector 0.7, databases created by an older image keep their extension version
+        conn.execute('ALTER EXTENSION vector UPDATE')
+    # Each request checks out its own connection, connections are checked before being handed out
+    self.pool = ConnectionPool(conninfo, min_size=self.pool_min_size, max_size=self.pool_max_size, configure=self.configure_connection, check=ConnectionPool.check_connection, open=True)
+    with self.pool.connection() as conn:
+      # One row per uploaded file, with its content hash used to skip re-uploads and the size listed by /load/
+      conn.execute('CREATE TABLE IF NOT EXISTS files (file_id text PRIMARY KEY, filename text NOT NULL, file_hash text, size bigint NOT NULL DEFAULT 0, '
+                   'chunk_count integer NOT NULL DEFAULT 0, created_at timestamptz NOT NULL DEFAULT now())')
+      # Chunker the file was split with, re-uploads of the same content only reuse its chunks if they choose the same chunker
+      conn.execute('ALTER TABLE files ADD COLUMN IF NOT EXISTS chunker text')
+      # Files being ingested are not ready, their chunks are inserted batch by batch and hidden from searches until the file is complete
+      conn.execute('ALTER TABLE files ADD COLUMN IF NOT EXISTS ready boolean NOT NULL DEFAULT true')
+      # Chunks are deleted with their file
+      conn.execute(f'CREATE TABLE IF NOT EXISTS vectordb (id SERIAL PRIMARY KEY, file_id text REFERENCES files (file_id) ON DELETE CASCADE, '
+                   f'embedding {self.vector_type}({self.embedding_dim}), text text, length integer)')
+      # Content hash of the chunk text, used to reuse embeddings
+      conn.execute('ALTER TABLE vectordb ADD COLUMN IF NOT EXISTS text_hash text')
+      conn.execute('CREATE INDEX IF NOT EXISTS vectordb_text_hash_idx ON vectordb (text_hash)')
+      conn.execute('CREATE INDEX IF NOT EXISTS vectordb_file_id_idx ON vectordb (file_id)')
+      conn.execute('CREATE TABLE IF NOT EXISTS corpus_version (id integer PRIMARY KEY, version bigint)')
+      conn.execute('INSERT INTO corpus_version (id, version) VALUES (1, 0) ON CONFLICT DO NOTHING')
+    self.migrate_files_table()
+    self.remove_pending_files()
+    self.migrate_vector_type()
+    self.create_vector_index()
+    # Load the keyword index from the snapshot if it matches the corpus in postgres
+    with self.pool.connection() as conn:
+      self.corpus_version = conn.execute('SELECT version FROM corpus_version WHERE id = 1').fetchone()[0]
+      for file_hash, chunker, file_id in conn.execute('SELECT file_hash, chunker, file_id FROM files WHERE file_hash IS NOT NULL AND ready ORDER BY created_at').fetchall():
+        self.file_hashes.setdefault((file_hash, chunker), []).append(file_id)
+    rebuilt = not self.load_snapshot()
+    if rebuilt:
+      # Otherwise rebuild it from the vectordb table
+      self.rebuild_keyword_index()
+    self.started = True
+    if rebuilt:
+      self.save_snapshot()
+    return
+
+
+  def rebuild_keyword_index(self):
+    with self.pool.connection() as conn:
+      filenames = dict(conn.execute('SELECT file_id, filename FROM files WHERE ready').fetchall())
+      results = conn.execute('SELECT v.id, v.file_id, v.text FROM vectordb v JOIN files f ON f.file_id = v.file_id WHERE f.ready ORDER BY v.id').fetchall()
+    if len(filenames) > 0:
+      row_ids = dict()
+      for row_id, file_id, text in results:
+        if file_id not in row_ids:
           self.corpus_dict[file_id] = []
+          row_ids[file_id] = []
         self.corpus_dict[file_id].append(text)
+        row_ids[file_id].append(row_id)
+      # Files without chunks are indexed too so that they can be removed
+      for file_id in filenames:
+        if file_id not in row_ids:
+          self.corpus_dict[file_id] = []
+          row_ids[file_id] = []
       try:
         # Add documents to BM25 model
-        # Tokenize the corpus and only keep the ids (faster and saves memory)
-        full_corpus = []
-        for texts in self.corpus_dict.values():
-          full_corpus += texts
-        corpus_tokens = bm25s.tokenize(full_corpus, stopwords="en")
-        # Index the corpus
-        self.retriever.index(corpus_tokens)
+        for file_id in row_ids:
+          self.index_chunks(file_id, filenames[file_id], self.corpus_dict[file_id], row_ids[file_id])
       except Exception as e:
         print("Error in adding documents to BM25 model")
         print(e)
         raise
+    return
 
 
   def clear_database(self):
     pass
+
+
+  def load_snapshot(self):
+    # Returns True if the keyword index was loaded from a snapshot of the current corpus version
+    if self.snapshot_dir is None or not os.path.exists(os.path.join(self.snapshot_dir, "chunks.json")):
+      return False
+    try:
+      with open(os.path.join(self.snapshot_dir, "chunks.json")) as f:
+        snapshot = json.load(f)
+      if snapshot["version"] != self.corpus_version:
+        print(f"Keyword index snapshot is at version {snapshot['version']}, corpus is at version {self.corpus_version}, rebuilding")
+        return False
+      keyword_index = KeywordIndex.load(self.snapshot_dir)
+    except Exception as e:
+      print("Error in loading keyword index snapshot")
+      print(e)
+      return False
+    self.keyword_index = keyword_index
+    self.chunk_texts = snapshot["chunk_texts"]
+    self.chunk_files = [[tuple(owner) for owner in owners] if owners is not None else None for owners in snapshot["chunk_files"]]
+    self.text_chunks = {text: chunk_id for chunk_id, text in enumerate(self.chunk_texts) if text is not None}
+    for file_id, chunk_ids in snapshot["files"].items():
+      self.chunk_ids[file_id] = chunk_ids
+      self.corpus_dict[file_id] = [self.chunk_texts[chunk_id] for chunk_id in chunk_ids]
+    print(f"Loaded keyword index snapshot at version {self.corpus_version}")
+    return True
+
+
+  def save_snapshot(self):
+    # Write the keyword index and chunk arrays to a new directory and swap it in
+    # Nothing is saved before start() has loaded the index, an empty index would replace the snapshot
+    if self.snapshot_dir is None or not self.started:
+      return
+    # One snapshot is written at a time
+    with self.snapshot_lock:
+      # Copy the index under the lock and write the copy without it, so that searches are not blocked by the write
+      with self.index_lock:
+        # Only save a state that matches a version in postgres
+        if self.changes_in_flight > 0:
+          self.schedule_snapshot()
+          return
+        arrays, vocab = self.keyword_index.to_arrays()
+        chunks = {"version": self.corpus_version, "chunk_texts": list(self.chunk_texts),
+                  "chunk_files": [list(owners) if owners is not None else None for owners in self.chunk_files],
+                  "files": {file_id: list(chunk_ids) for file_id, chunk_ids in self.chunk_ids.items()}}
+      tmp_dir = self.snapshot_dir.rstrip("/") + ".tmp"
+      old_dir = self.snapshot_dir.rstrip("/") + ".old"
+      try:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        KeywordIndex.save_arrays(tmp_dir, arrays, vocab)
+        with open(os.path.join(tmp_dir, "chunks.json"), "w") as f:
+          json.dump(chunks, f)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(self.snapshot_dir):
+          os.rename(self.snapshot_dir, old_dir)
+        os.rename(tmp_dir, self.snapshot_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+      except Exception as e:
+        print("Error in saving keyword index snapshot")
+        print(e)
+    return
+
+
+  def schedule_snapshot(self):
+    # Save a snapshot once no change has happened for snapshot_delay seconds
+    if self.snapshot_dir is None:
+      return
+    if self.snapshot_timer is not None:
+      self.snapshot_timer.cancel()
+    self.snapshot_timer = threading.Timer(self.snapshot_delay, self.save_snapshot)
+    self.snapshot_timer.daemon = True
+    self.snapshot_timer.start()
+    return
+
+
+  def bump_corpus_version(self, conn):
+    # Called in the same transaction as the change to vectordb
+    return conn.execute('UPDATE corpus_version SET version = version + 1 WHERE id = 1 RETURNING version').fetchone()[0]
+
+
+  def vector_index_name(self):
+    # Indexes of float32 embeddings without quantization keep their original names
+    vector_type = "" if self.vector_type == "vector" else f"_{self.vector_type}"
+    quantization = "" if self.vector_quantization == "none" else f"_{self.vector_quantization}"
+    return f"vectordb_embedding_{self.vector_index}_{self.vector_distance}{vector_type}{quantization}_idx"
+
+
+  def drop_vector_indexes(self, conn, keep=None):
+    # Drop the ANN indexes of vectordb other than keep, including copies left by failed concurrent rebuilds, returns the names of the existing indexes
+    existing_indexes = [index_name for (index_name,) in conn.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'vectordb' AND indexname LIKE 'vectordb_embedding_%_idx%'").fetchall()]
+    for index_name in existing_indexes:
+      if index_name != keep:
+        conn.execute(f'DROP INDEX IF EXISTS {index_name}')
+    conn.commit()
+    return existing_indexes
+
+
+  def migrate_files_table(self):
+    # Move the filename and content hash of databases created before the files table from the chunk rows into files
+    with self.pool.connection() as conn:
+      columns = [column for (column,) in conn.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'vectordb' AND column_name IN ('filename', 'file_hash')").fetchall()]
+      if "filename" not in columns:
+        return
+      print("Migrating filenames from vectordb to the files table...")
+      file_hash = "MIN(file_hash)" if "file_hash" in columns else "NULL"
+      conn.execute(f'INSERT INTO files (file_id, filename, file_hash, size, chunk_count) SELECT file_id, MIN(filename), {file_hash}, SUM(length), COUNT(*) '
+                   'FROM vectordb GROUP BY file_id ON CONFLICT DO NOTHING')
+      conn.execute('ALTER TABLE vectordb ADD CONSTRAINT vectordb_file_id_fkey FOREIGN KEY (file_id) REFERENCES files (file_id) ON DELETE CASCADE')
+      conn.execute('ALTER TABLE vectordb DROP COLUMN filename, DROP COLUMN IF EXISTS file_hash')
+    print("Migrated filenames to the files table")
+    return
+
+
+  def migrate_vector_type(self):
+    # Convert the embedding column of existing rows when the vector type changed, converting to halfvec rounds the embeddings to float16
+    column_type = f"{self.vector_type}({self.embedding_dim})"
+    with self.pool.connection() as conn:
+      current_type = conn.execute("SELECT format_type(atttypid, atttypmod) FROM pg_attribute WHERE attrelid = 'vectordb'::regclass AND attname = 'embedding'").fetchone()[0]
+      if current_type == column_type:
+        return
+      print(f"Migrating embeddings from {current_type} to {column_type}...")
+      # The ANN indexes are built for the old type, create_vector_index rebuilds the configured one
+      self.drop_vector_indexes(conn)
+      conn.execute(f'ALTER TABLE vectordb ALTER COLUMN embedding TYPE {column_type} USING embedding::{column_type}')
+    print(f"Migrated embeddings to {column_type}")
+    return
+
+
+  def configure_connection(self, conn):
+    # Called by the pool for every new connection
+    register_vector(conn)
+    self.set_search_params(conn, self.ef_search, self.probes)
+    return
+
+
+  def set_search_params(self, conn, ef_search=None, probes=None, local=False):
+    # Set the query-time accuracy/speed knobs of the ANN index
+    # local=True only applies them to the current transaction
+    if ef_search is not None:
+      conn.execute("SELECT set_config('hnsw.ef_search', %s, %s)", (str(ef_search), local))
+    if probes is not None:
+      conn.execute("SELECT set_config('ivfflat.probes', %s, %s)", (str(probes), local))
+    if not local:
+      conn.commit()
+    return
+
+
+  def create_vector_index(self):
+    # Create the configured ANN index and drop indexes built with another configuration
+    index_name = self.vector_index_name()
+    # Binary quantization indexes the sign bits of the embeddings
+    if self.vector_quantization == "binary":
+      indexed, operator_class = f"(binary_quantize(embedding)::bit({self.embedding_dim}))", "bit_hamming_ops"
+    else:
+      indexed, operator_class = "embedding", self.operator_class
+    with self.pool.connection() as conn:
+      existing_indexes = self.drop_vector_indexes(conn, keep=index_name)
+      if self.vector_index == "none" or index_name in existing_indexes:
+        if self.vector_index == "ivfflat":
+          self.vector_index_rows = conn.execute('SELECT COUNT(*) FROM vectordb').fetchone()[0]
+        return
+      if self.vector_index == "hnsw":
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON vectordb USING hnsw ({indexed} {operator_class}) WITH (m = {self.hnsw_m}, ef_construction = {self.hnsw_ef_construction})')
+      else:
+        # IVFFlat clusters the existing rows, so only build it once there are enough rows for its lists
+        rows = conn.execute('SELECT COUNT(*) FROM vectordb').fetchone()[0]
+        if rows < self.ivfflat_lists:
+          return
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON vectordb USING ivfflat ({indexed} {operator_class}) WITH (lists = {self.ivfflat_lists})')
+        self.vector_index_rows = rows
+    print("Created vector index: ", index_name)
+    return
+
+
+  def maintain_vector_index(self):
+    # HNSW is updated on insert; IVFFlat is built lazily and rebuilt when the table has doubled since its clusters were computed
+    if self.vector_index != "ivfflat":
+      return
+    with self.vector_index_lock:
+      if self.vector_index_rows == 0:
+        self.create_vector_index()
+        return
+      with self.pool.connection() as conn:
+        # REINDEX CONCURRENTLY cannot run in a transaction, and a plain REINDEX would block vector searches until the rebuild is done
+        conn.autocommit = True
+        try:
+          rows = conn.execute('SELECT COUNT(*) FROM vectordb').fetchone()[0]
+          if rows < 2 * self.vector_index_rows:
+            return
+          try:
+            conn.execute(f'REINDEX INDEX CONCURRENTLY {self.vector_index_name()}')
+          except Exception:
+            # A failed concurrent rebuild leaves its invalid copy of the index behind
+            conn.execute(f'DROP INDEX IF EXISTS {self.vector_index_name()}_ccnew')
+            raise
+        finally:
+          conn.autocommit = False
+      self.vector_index_rows = rows
+      print("Rebuilt vector index: ", self.vector_index_name())
+    return
   
 
-  def split_document(self, document: str, chunk_size: int=4000, chunk_overlap: int=1500):
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        length_function=len,
-        is_separator_regex=False,
-    )
-    texts = text_splitter.create_documents([document])
-    corpus = [text.page_content for text in texts]
-    return corpus
+  def split_document(self, document: str, chunker=None):
+    # Split with the named chunker, or the default chunker if none is given
+    return self.chunkers[chunker or self.default_chunker].split(document)
     
 
-  def add_documents(self, filename: str, corpus: list):
-    # Create a unique id for the file
-    file_id = str(uuid.uuid4())
+  def index_chunks(self, file_id: str, filename: str, corpus: list, row_ids: list):
+    # Tokenize and index only the chunks of this file whose text is not indexed yet
+    # so that chunks shared between files do not skew the BM25 statistics or fill the top-k twice
+    new_texts = list(dict.fromkeys(text for text in corpus if text not in self.text_chunks))
+    for chunk_id, text in zip(self.keyword_index.add(new_texts), new_texts):
+      if chunk_id >= len(self.chunk_texts):
+        self.chunk_texts.extend([None] * (chunk_id + 1 - len(self.chunk_texts)))
+        self.chunk_files.extend([None] * (chunk_id + 1 - len(self.chunk_files)))
+      self.chunk_texts[chunk_id] = text
+      self.chunk_files[chunk_id] = []
+      self.text_chunks[text] = chunk_id
+    chunk_ids = [self.text_chunks[text] for text in corpus]
+    for chunk_id, row_id in zip(chunk_ids, row_ids):
+      self.chunk_files[chunk_id].append((file_id, filename, row_id))
+    self.chunk_ids[file_id] = chunk_ids
+    return chunk_ids
+
+
+  def unindex_chunks(self, file_id: str):
+    # Chunks are removed from the keyword index once no file contains them
+    chunk_ids = self.chunk_ids.pop(file_id, [])
+    for chunk_id in set(chunk_ids):
+      self.chunk_files[chunk_id] = [owner for owner in self.chunk_files[chunk_id] if owner[0] != file_id]
+      if len(self.chunk_files[chunk_id]) == 0:
+        self.keyword_index.remove([chunk_id])
+        del self.text_chunks[self.chunk_texts[chunk_id]]
+        self.chunk_texts[chunk_id] = None
+        self.chunk_files[chunk_id] = None
+    return
+
 
-    # Add documents to the corpus dict
-    self.corpus_dict[file_id] = corpus
+  def uploaded_corpus(self, file_hash, chunker):
+    # Chunks of a stored file with the same content split by the same chunker, None if there is none
+    if file_hash is None:
+      return None
+    with self.index_lock:
+      for file_id in self.file_hashes.get((file_hash, chunker), []):
+        if file_id in self.corpus_dict:
+          return list(self.corpus_dict[file_id])
+    return None
 
+
+  def add_uploaded_copy(self, filename: str, file_hash, chunker, progress=None):
+    # A re-upload of a file with the same content and chunker is added as a new file with the chunks of the stored file,
+    # which skips parsing and reuses all embeddings, returns False if no such file is stored
+    corpus = self.uploaded_corpus(file_hash, chunker)
+    if corpus is None:
+      return False
+    print(f"Reusing the chunks of an earlier upload with the same content for {filename}")
+    if progress is not None:
+      progress("reused")
+    self.add_documents(filename, corpus, progress, file_hash, chunker)
+    return True
+
+
+  def remove_pending_files(self, file_id=None):
+    # Remove a file whose ingestion failed, or all files left pending by a server that stopped while ingesting them, with their chunks
     try:
-      # Add documents to BM25 model
-      # Tokenize the corpus and only keep the ids (faster and saves memory)
-      full_corpus = []
-      for texts in self.corpus_dict.values():
-        full_corpus += texts
-      corpus_tokens = bm25s.tokenize(full_corpus, stopwords="en")
-      # Index the corpus
-      self.retriever.index(corpus_tokens)
+      with self.pool.connection() as conn:
+        if file_id is None:
+          removed = conn.execute('DELETE FROM files WHERE NOT ready').rowcount
+        else:
+          removed = conn.execute('DELETE FROM files WHERE file_id = %s AND NOT ready', (file_id,)).rowcount
+      if removed > 0:
+        print(f"Removed {removed} files left pending by failed ingestions")
     except Exception as e:
-      print("Error in adding documents to BM25 model")
+      print("Error in removing pending files")
       print(e)
-      raise
+    return
+
+
+  def reusable_embeddings(self, conn, texts: list):
+    # Embeddings of chunks with the same text in any file, keyed by text hash
+    hashes = list(set(text_hash(text) for text in texts))
+    return dict(conn.execute('SELECT DISTINCT ON (text_hash) text_hash, embedding::vector FROM vectordb WHERE text_hash = ANY(%s)', (hashes,)).fetchall())
+
+
+  def insert_chunks(self, conn, file_id: str, corpus: list, embeddings):
+    # Bulk insert all chunks of a file with a binary COPY instead of one INSERT per chunk
+    # COPY cannot return the generated ids, so reserve them from the id sequence first
+    if len(corpus) == 0:
+      return []
+    row_ids = [row_id for (row_id,) in conn.execute("SELECT nextval(pg_get_serial_sequence('vectordb', 'id')) FROM generate_series(1, %s)", (len(corpus),)).fetchall()]
+    with conn.cursor() as cur:
+      with cur.copy('COPY vectordb (id, file_id, embedding, text, length, text_hash) FROM STDIN WITH (FORMAT BINARY)') as copy:
+        copy.set_types(['int4', 'text', self.vector_type, 'text', 'int4', 'text'])
+        for row_id, text, embedding in zip(row_ids, corpus, embeddings):
+          copy.write_row((row_id, file_id, np.asarray(embedding, dtype=np.float32), text, len(text), text_hash(text)))
+    return row_ids
+
+
+  def add_documents(self, filename: str, corpus: list, progress=None, file_hash=None, chunker=None):
+    # Embed and insert the chunks in batches of embed_batch_size
+    batches = (corpus[start:start + self.embed_batch_size] for start in range(0, len(corpus), self.embed_batch_size))
+    return self.add_document_batches(filename, batches, progress, file_hash, chunker)
+
+
+  def add_document_batches(self, filename: str, batches, progress=None, file_hash=None, chunker=None):
+    # batches yields lists of chunks, each list is embedded and copied into the vector database before the next one is read
+    # so only one batch of embeddings is held in memory
+    # Each batch is inserted in its own transaction so that no connection is held while the next batch is parsed or transcribed,
+    # the file stays pending until all batches are inserted and is removed with its chunks if the ingestion fails
+    # Create a unique id for the file
+    file_id = str(uuid.uuid4())
+    corpus = []
+    row_ids = []
+    embed_ms = 0
+    insert_ms = 0
 
     try:
       # Add documents to the vector database
-      # Embed the corpus
-      embeddings = self.embedding_model.encode(corpus)
-      for text, embedding in zip(corpus, embeddings):
-        length = len(text)
-        self.conn.execute('INSERT INTO vectordb (file_id, embedding, filename, text, length) VALUES (%s, %s, %s, %s, %s)', (file_id, np.array(embedding), filename, text, length))
-      self.conn.commit()
+      # The file row is inserted first for the foreign key of its chunks, its size and chunk count are set once all chunks are inserted
+      with self.pool.connection() as conn:
+        conn.execute('INSERT INTO files (file_id, filename, file_hash, chunker, ready) VALUES (%s, %s, %s, %s, false)', (file_id, filename, file_hash, chunker))
+      for batch in batches:
+        # Embed only the chunks whose text has not been embedded before, in this file or any other
+        with self.pool.connection() as conn:
+          embeddings, lookup_ms = timed(self.reusable_embeddings, conn, batch)
+        new_texts = list(dict.fromkeys(text for text in batch if text_hash(text) not in embeddings))
+        if len(new_texts) > 0:
+          new_embeddings, batch_embed_ms = timed(self.embedding_model.encode, new_texts)
+          embed_ms += batch_embed_ms
+          for text, embedding in zip(new_texts, new_embeddings):
+            embeddings[text_hash(text)] = embedding
+        print(f"Embedded {len(new_texts)} of {len(batch)} chunks, reused {len(batch) - len(new_texts)}")
+        self.metrics.inc("retrieval_ingested_chunks_total", ("embedded",), len(new_texts))
+        self.metrics.inc("retrieval_ingested_chunks_total", ("reused",), len(batch) - len(new_texts))
+        with self.pool.connection() as conn:
+          batch_row_ids, batch_insert_ms = timed(self.insert_chunks, conn, file_id, batch, [embeddings[text_hash(text)] for text in batch])
+        row_ids.extend(batch_row_ids)
+        insert_ms += lookup_ms + batch_insert_ms
+        corpus.extend(batch)
+        del embeddings
+      # The file becomes searchable in the same transaction as the corpus version is bumped
+      with self.index_lock:
+        self.changes_in_flight += 1
+      try:
+        with self.pool.connection() as conn:
+          conn.execute('UPDATE files SET size = %s, chunk_count = %s, ready = true WHERE file_id = %s', (sum(len(text) for text in corpus), len(corpus), file_id))
+          version = self.bump_corpus_version(conn)
+      except Exception:
+        with self.index_lock:
+          self.changes_in_flight -= 1
+        raise
     except Exception as e:
       print("Error in adding documents to vector database")
       print(e)
+      self.remove_pending_files(file_id)
       raise
+    if progress is not None:
+      progress("embedded")
 
-    return
-  
-
-  async def add_text_document(self, file, filename: str):
-    doc_text = ""
     try:
-      # Read the document 
-      file_content = await file.read()
-      doc = pymupdf.open(stream=file_content)
-      doc_text = pymupdf4llm.to_markdown(doc)
+      with self.index_lock:
+        try:
+          # Add documents to the corpus dict
+          self.corpus_dict[file_id] = corpus
+          # Add documents to BM25 model
+          _, index_ms = timed(self.index_chunks, file_id, filename, corpus, row_ids)
+          if file_hash is not None:
+            self.file_hashes.setdefault((file_hash, chunker), []).append(file_id)
+          self.corpus_version = max(self.corpus_version, version)
+        finally:
+          self.changes_in_flight -= 1
     except Exception as e:
-      print("Error in reading the document")
+      print("Error in adding documents to BM25 model")
       print(e)
       raise
-    
+    self.schedule_snapshot()
+    # The file is committed and searchable, a failed IVFFlat rebuild leaves the old index in place and is retried on the next upload
+    try:
+      self.maintain_vector_index()
+    except Exception as e:
+      print("Error in maintaining vector index")
+      print(e)
+    for stage, ms in [("embed", embed_ms), ("insert", insert_ms), ("index", index_ms)]:
+      self.metrics.observe("retrieval_ingestion_stage_seconds", (stage,), ms / 1000)
+
+    if progress is not None:
+      progress("indexed")
+    return
+
+
+  def stream_document_chunks(self, texts, chunker=None, progress=None):
+    # Split each piece of the document (the markdown of a page range or a transcribed speech segment) as it arrives
+    # and yield batches of embed_batch_size chunks
+    # The last chunk of every piece may continue in the next piece, so it is carried over and split again
+    # together with the next piece, which keeps the chunk overlap across page and segment boundaries
+    carry = ""
+    batch = []
+    parse_ms = 0
+    chunk_ms = 0
+    texts = iter(texts)
+    while True:
+      # Time spent waiting for the next piece is parsing (or transcription) time
+      text, next_ms = timed(next, texts, None)
+      parse_ms += next_ms
+      if text is None:
+        break
+      chunks, split_ms = timed(self.split_document, carry + text, chunker)
+      chunk_ms += split_ms
+      carry = chunks.pop() if len(chunks) > 0 else ""
+      for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) == self.embed_batch_size:
+          yield batch
+          batch = []
+    self.metrics.observe("retrieval_ingestion_stage_seconds", ("parse",), parse_ms / 1000)
+    self.metrics.observe("retrieval_ingestion_stage_seconds", ("chunk",), chunk_ms / 1000)
+    if progress is not None:
+      progress("parsed")
+    if carry != "":
+      batch.append(carry)
+    if progress is not None:
+      progress("chunked")
+    if len(batch) > 0:
+      yield batch
+
+
+  def add_text_document(self, filepath: str, filename: str, filetype=None, file_hash=None, chunker=None, progress=None):
+    # The upload is read from disk page by page instead of converting the whole document at once
+    # Re-uploads of a file with the same content and chunker are not parsed again
+    chunker = chunker or self.default_chunker
     try:
-      # Split the document into smaller texts
-      corpus = self.split_document(doc_text)
-      self.add_documents(filename, corpus)
+      if self.add_uploaded_copy(filename, file_hash, chunker, progress):
+        return
+      # The pages are converted in the parser processes, split the document into smaller texts as they arrive
+      markdown_pages = self.document_parser.iter_markdown(filepath, filetype, self.page_batch_size)
+      self.add_document_batches(filename, self.stream_document_chunks(markdown_pages, chunker, progress), progress, file_hash, chunker)
       return
     except Exception as e:
       print("Error in adding document to the corpus")
@@ -131,127 +649,379 @@ class HybridSearch:
       raise
 
 
-  def add_image(self, file, filename: str):
-    # Initialize the image caption model and delete it after use
-    image_caption_model = ImageCaptionModel()
-    caption = image_caption_model.generate(file)
-    del image_caption_model
-    gc.collect()
-    torch.cuda.empty_cache()
-    corpus = self.split_document(caption)
-    self.add_documents(filename, corpus)
-    return
+  def add_image(self, file, filename: str, file_hash=None, chunker=None, progress=None):
+    return self.add_images([file], [filename], [file_hash], chunker, progress)
         
     
-  def add_speech(self, filepath: str, filename: str):
-    # Initialize the speech recognition model and delete it after use
-    speech_recognition_model = SpeechRecognitionModel()
-    speech = speech_recognition_model.generate(filepath)
-    del speech_recognition_model
-    gc.collect()
-    torch.cuda.empty_cache()
-    corpus = self.split_document(speech)
-    self.add_documents(filename, corpus)
+  def add_images(self, files: list, filenames: list, file_hashes=None, chunker=None, progress=None):
+    # Caption all images in batches with one use of the model, each image is added as its own file
+    # Images with the same content and chunker as an earlier upload reuse its chunks instead of being captioned again
+    if file_hashes is None:
+      file_hashes = [None] * len(files)
+    chunker = chunker or self.default_chunker
+    new_images = [i for i in range(len(files)) if not self.add_uploaded_copy(filenames[i], file_hashes[i], chunker, progress)]
+    if len(new_images) == 0:
+      return
+    # The image caption model is loaded on first use and evicted by the model manager when idle
+    with self.model_manager.use("image_caption") as image_caption_model:
+      captions, caption_ms = timed(image_caption_model.generate_batch, [files[i] for i in new_images])
+    # Images that could not be read are not ingested, the job fails once the other images are added
+    failed = [filenames[i] for i, caption in zip(new_images, captions) if caption is None]
+    positions = [i for i, caption in zip(new_images, captions) if caption is not None]
+    captions = [caption for caption in captions if caption is not None]
+    if progress is not None:
+      progress("parsed")
+    corpora, chunk_ms = timed(lambda: [self.split_document(caption, chunker) for caption in captions])
+    if progress is not None:
+      progress("chunked")
+    # The images are captioned and chunked together, each gets an equal share
+    for i in positions:
+      self.metrics.observe("retrieval_ingestion_stage_seconds", ("parse",), caption_ms / 1000 / len(positions))
+      self.metrics.observe("retrieval_ingestion_stage_seconds", ("chunk",), chunk_ms / 1000 / len(positions))
+    for i, corpus in zip(positions, corpora):
+      self.add_documents(filenames[i], corpus, progress, file_hashes[i], chunker)
+    if len(failed) > 0:
+      raise ValueError(f"Could not read the images: {', '.join(failed)}")
+    return
+
+
+  def add_speech(self, filepath: str, filename: str, file_hash=None, chunker=None, progress=None):
+    # Re-uploads of a recording with the same content and chunker are not transcribed again
+    chunker = chunker or self.default_chunker
+    if self.add_uploaded_copy(filename, file_hash, chunker, progress):
+      return
+    # The speech recognition model is loaded on first use and evicted by the model manager when idle
+    with self.model_manager.use("speech_recognition") as speech_recognition_model:
+      # Transcribed segments are chunked, embedded and inserted while the rest of the recording is transcribed
+      segments = (text.strip() + " " for text in speech_recognition_model.generate_segments(filepath))
+      self.add_document_batches(filename, self.stream_document_chunks(segments, chunker, progress), progress, file_hash, chunker)
     return
     
 
   def remove_documents(self, file_id: str):
+    # Remove documents from the vector database first, the keyword index only drops files that are gone from postgres
+    with self.index_lock:
+      self.changes_in_flight += 1
+    try:
+      with self.pool.connection() as conn:
+        # The chunks of the file are deleted by the foreign key
+        conn.execute('DELETE FROM files WHERE file_id = %s', (file_id,))
+        version = self.bump_corpus_version(conn)
+    except Exception:
+      with self.index_lock:
+        self.changes_in_flight -= 1
+      raise
+
     # Remove documents from BM25 model
     # Remove from corpus
-    del self.corpus_dict[file_id]
-    if len(self.corpus_dict) == 0:
-      self.retriever = bm25s.BM25()
-    else:
-      # Tokenize the corpus and only keep the ids (faster and saves memory)
-      full_corpus = []
-      for texts in self.corpus_dict.values():
-        full_corpus += texts
-      corpus_tokens = bm25s.tokenize(full_corpus, stopwords="en")
-      # Index the corpus
-      self.retriever.index(corpus_tokens)
-
-    # Remove documents from the vector database
-    self.conn.execute('DELETE FROM vectordb WHERE file_id = %s', (file_id,))
-    self.conn.commit()
+    with self.index_lock:
+      try:
+        row_ids = [row_id for chunk_id in set(self.chunk_ids.get(file_id, [])) for owner_id, filename, row_id in self.chunk_files[chunk_id] if owner_id == file_id]
+        self.corpus_dict.pop(file_id, None)
+        for key in [key for key, owner_ids in self.file_hashes.items() if file_id in owner_ids]:
+          self.file_hashes[key].remove(file_id)
+          if len(self.file_hashes[key]) == 0:
+            del self.file_hashes[key]
+        self.unindex_chunks(file_id)
+        self.corpus_version = max(self.corpus_version, version)
+      finally:
+        self.changes_in_flight -= 1
+    # Drop the cached reranker scores of the removed chunks
+    self.reranker.invalidate(row_ids)
+    self.schedule_snapshot()
+    return
+
+
+  def observe_stage(self, stage: str, ms: float, call: str="single"):
+    self.metrics.observe("retrieval_search_stage_seconds", (stage, call), ms / 1000)
     return
 
 
   def keyword_search(self, query, k=3):
     # Query the BM25 model
-    query_tokens = bm25s.tokenize(query)
-    full_corpus = []
-    for texts in self.corpus_dict.values():
-      full_corpus += texts
-    # Ensure k is within the valid range
-    k = min(k, len(full_corpus))
-    if k < 1:
-        k = 1
-    bm25_results, bm25_scores = self.retriever.retrieve(query_tokens, corpus=full_corpus, k=k)
-    docs = []
-    filenames = set()
-    for i in range(bm25_results.shape[1]):
-        doc = bm25_results[0, i]
-        docs.append(doc)
-        for file_id, texts in self.corpus_dict.items():
-          if doc in texts:
-            # Get the filename
-            filename_result = self.conn.execute('SELECT filename FROM vectordb WHERE file_id = %s', (file_id,)).fetchone()
-            filename = filename_result[0]
-            filenames.add(filename)
-            break
-    return docs, filenames
-
-
-  def vector_search(self, query, k=3):
-    # Query the vector database
-    embedding = self.embedding_model.encode(query)
-    vector_results = self.conn.execute(f'SELECT embedding, text, filename FROM vectordb ORDER BY embedding <-> %s LIMIT {k}', (np.array(embedding),)).fetchall()
-    docs = [text for (embedding, text, filename) in vector_results]
-    filenames = set([filename for (embedding, text, filename) in vector_results])
-    return docs, filenames
-
-
-  def rerank(self, query, docs, k=3):
-    # Add the query to the list of documents and remove duplicates
-    query_doc_pairs = []
-    seen_docs = []
-    for doc in docs:
-      if doc not in seen_docs:
-        query_doc_pairs.append([query, doc])
-        seen_docs.append(doc)
-    # Compute the scores
-    scores = self.reranker.compute_score(query_doc_pairs)
-    # Sort the documents by score
-    reranked_docs = [doc for score, doc in sorted(zip(scores, seen_docs), reverse=True)]
-    # Return top-k documents
-    if len(reranked_docs) < k:
-      return reranked_docs
-    else:
-      return reranked_docs[:k]
+    return self.keyword_search_batch([query], k, call="single")[0]
+
+
+  def keyword_search_batch(self, queries, k=3, call="batch"):
+    # Query the BM25 model with all queries tokenized together
+    results = []
+    query_tokens, tokenize_ms = timed(self.keyword_index.tokenize, queries)
+    self.observe_stage("tokenize", tokenize_ms, call)
+    with self.index_lock:
+      retrieved, retrieve_ms = timed(self.keyword_index.retrieve_tokens_batch, query_tokens, k)
+      self.observe_stage("bm25", retrieve_ms, call)
+      for chunk_ids, bm25_scores in retrieved:
+        docs = []
+        filenames = set()
+        row_ids = []
+        for chunk_id in chunk_ids:
+          docs.append(self.chunk_texts[chunk_id])
+          # Attribute the chunk to the first file containing it through the chunk id
+          file_id, filename, row_id = self.chunk_files[chunk_id][0]
+          filenames.add(filename)
+          row_ids.append(row_id)
+        results.append((docs, filenames, row_ids))
+    return results
+
+
+  def nearest_rows_sql(self, query_sql: str, limit: int):
+    # SQL selecting id, text, file_id and distance of the limit rows nearest to the query embedding (an SQL expression of type vector)
+    distance = f'embedding {self.distance_operator} {query_sql}::{self.vector_type}'
+    if self.vector_quantization == "none":
+      return f'SELECT id, text, file_id, {distance} AS distance FROM vectordb ORDER BY distance LIMIT {limit}'
+    # The index ranks a shortlist by the Hamming distance of the sign bits, which is re-scored with the exact distance
+    shortlist = (f'SELECT id, text, file_id, embedding FROM vectordb ORDER BY binary_quantize(embedding)::bit({self.embedding_dim}) <~> '
+                 f'binary_quantize({query_sql}::{self.vector_type})::bit({self.embedding_dim}) LIMIT {self.index_limit(limit)}')
+    return f'SELECT id, text, file_id, {distance} AS distance FROM ({shortlist}) shortlist ORDER BY distance LIMIT {limit}'
+
+
+  def index_limit(self, limit: int):
+    # Rows the ANN index has to return for limit rows to be returned
+    return limit * self.rescore_factor if self.vector_quantization == "binary" else limit
+
+
+  def unique_rows_sql(self, query_sql: str, k: int, shortlist: int):
+    # SQL selecting id, text, filename and distance of the k rows of ready files with distinct texts nearest to the query embedding
+    # among its shortlist nearest rows, along with the rows found in the shortlist (fewer than shortlist when the whole table was searched)
+    # Filenames are joined in after the nearest rows are found
+    return (f'SELECT * FROM (SELECT DISTINCT ON (n.text) n.id, n.text, f.filename, n.distance, n.shortlist_rows '
+            f'FROM (SELECT *, COUNT(*) OVER () AS shortlist_rows FROM ({self.nearest_rows_sql(query_sql, shortlist)}) s) n '
+            f'JOIN files f ON f.file_id = n.file_id WHERE f.ready ORDER BY n.text, n.distance, n.id) u ORDER BY u.distance LIMIT {k}')
+
+
+  def nearest_texts(self, embeddings, k=3, ef_search=None, probes=None):
+    # Rows (id, text, filename) of the k distinct texts nearest to each embedding
+    # Files sharing a chunk have a row each, so the nearest rows are de-duplicated by text over a shortlist
+    # that is widened for the queries whose shortlist held fewer than k distinct texts
+    results = [[] for _ in embeddings]
+    pending = list(range(len(embeddings)))
+    shortlist = shortlist_factor * k
+    # HNSW returns at most ef_search rows and pgvector caps ef_search
+    max_shortlist = max(max_ef_search // self.index_limit(1), k)
+    with self.pool.connection() as conn:
+      while len(pending) > 0:
+        shortlist = min(shortlist, max_shortlist)
+        # Override the ANN search parameters for this query only
+        # HNSW returns at most ef_search rows, so it must be at least the rows the index returns
+        query_ef_search = ef_search
+        if query_ef_search is None and self.index_limit(shortlist) > self.ef_search:
+          query_ef_search = self.index_limit(shortlist)
+        self.set_search_params(conn, query_ef_search, probes, local=True)
+        rows = conn.execute(f'SELECT q.ord, v.id, v.text, v.filename, v.shortlist_rows FROM unnest(%s::vector[]) WITH ORDINALITY AS q(query_embedding, ord) '
+                            f'CROSS JOIN LATERAL ({self.unique_rows_sql("q.query_embedding", k, shortlist)}) v '
+                            'ORDER BY q.ord, v.distance', ([np.array(embeddings[i]) for i in pending],)).fetchall()
+        shortlist_rows = dict()
+        for i in pending:
+          results[i] = []
+        for ord, row_id, text, filename, rows_found in rows:
+          results[pending[ord - 1]].append((row_id, text, filename))
+          shortlist_rows[pending[ord - 1]] = rows_found
+        if shortlist >= max_shortlist:
+          break
+        # Widen the shortlist of the queries that are short of k texts while more rows remain
+        pending = [i for i in pending if len(results[i]) < k and shortlist_rows.get(i, 0) >= shortlist]
+        shortlist *= shortlist_factor
+    return results
+
 
+  def vector_search(self, query, k=3, ef_search=None, probes=None, embedding=None):
+    # Query the vector database, the query embedding can be passed in if it was already computed
+    if embedding is None:
+      embedding = self.embedding_model.encode(query)
+    vector_results = self.nearest_texts([embedding], k, ef_search, probes)[0]
+    docs = [text for (row_id, text, filename) in vector_results]
+    filenames = set([filename for (row_id, text, filename) in vector_results])
+    row_ids = [row_id for (row_id, text, filename) in vector_results]
+    return docs, filenames, row_ids
 
-  def search(self, query, k=3):
+
+  def vector_search_batch(self, queries, k=3):
+    # Embed all queries in one batch and search for all of them in one round trip
+    embeddings, embed_ms = timed(self.embedding_model.encode_batch, queries)
+    self.observe_stage("embed", embed_ms, "batch")
+    query_results, query_ms = timed(self.nearest_texts, embeddings, k)
+    self.observe_stage("vector_query", query_ms, "batch")
+    results = []
+    for rows in query_results:
+      results.append(([text for row_id, text, filename in rows], set([filename for row_id, text, filename in rows]), [row_id for row_id, text, filename in rows]))
+    return results
+
+
+  def rerank(self, query, docs, row_ids, k=3):
+    return self.rerank_batch([query], [docs], [row_ids], k)[0]
+
+
+  def rerank_batch(self, queries, docs_lists, row_ids_lists, k=3):
+    # Remove duplicate documents of each query
+    pair_queries = []
+    pair_docs = []
+    pair_row_ids = []
+    pair_counts = []
+    for query, docs, row_ids in zip(queries, docs_lists, row_ids_lists):
+      seen_docs = []
+      for doc, row_id in zip(docs, row_ids):
+        if doc not in seen_docs:
+          seen_docs.append(doc)
+          pair_queries.append(query)
+          pair_docs.append(doc)
+          pair_row_ids.append(row_id)
+      pair_counts.append(len(seen_docs))
+    # Compute the scores of all pairs in one batch, scores of (query, chunk) pairs seen before come from the reranker cache
+    scores = self.reranker.score_pairs(pair_queries, pair_docs, pair_row_ids)
+    results = []
+    start = 0
+    for count in pair_counts:
+      # Sort the documents by score
+      reranked_docs = [doc for score, doc in sorted(zip(scores[start:start + count], pair_docs[start:start + count]), reverse=True)]
+      start += count
+      # Return top-k documents
+      results.append(reranked_docs[:k])
+    return results
+
+
+  def fuse(self, keyword_docs, keyword_row_ids, vector_docs, vector_row_ids):
+    # Reciprocal rank fusion of the keyword and vector rankings, duplicate documents are merged
+    # Returns the documents, their row ids and the number of rankings each document was found in, best first
+    scores = {}
+    row_ids = {}
+    counts = {}
+    for docs, ids in [(keyword_docs, keyword_row_ids), (vector_docs, vector_row_ids)]:
+      for rank, (doc, row_id) in enumerate(zip(docs, ids)):
+        scores[doc] = scores.get(doc, 0) + 1 / (self.rrf_k + rank + 1)
+        row_ids.setdefault(doc, row_id)
+        counts[doc] = counts.get(doc, 0) + 1
+    fused_docs = sorted(scores, key=lambda doc: scores[doc], reverse=True)
+    return fused_docs, [row_ids[doc] for doc in fused_docs], [counts[doc] for doc in fused_docs]
+
+
+  def is_ambiguous(self, fused_counts, k=3):
+    # The fused top-k needs the reranker only if there are more than k candidates and the two rankings
+    # do not agree on k of them (documents found by both rankings always fuse above the others)
+    return len(fused_counts) > k and sum(count > 1 for count in fused_counts) < k
+
+
+  def vector_stage(self, query, k=3):
+    # Embed the query once and search the vector database with it
+    embedding, embed_ms = timed(self.embedding_model.encode, query)
+    vector_results, query_ms = timed(self.vector_search, query, k, embedding=embedding)
+    self.observe_stage("embed", embed_ms)
+    self.observe_stage("vector_query", query_ms)
+    return vector_results, embed_ms, query_ms
+
+
+  def search(self, query, k=3, mode="rerank"):
+    if mode not in search_modes:
+      raise ValueError(f"Unknown search mode {mode}, expected one of {search_modes}")
     if len(self.corpus_dict) > 0:
-      print("Keyword Search...")
-      keyword_docs, keyword_filenames = self.keyword_search(query, k)
-      print("Vector Search...")
-      vector_docs, vector_filenames = self.vector_search(query, k)
-      all_docs = keyword_docs + vector_docs
+      start = time.perf_counter()
+      # The vector search mostly waits on the embedding model and postgres, so run it while BM25 runs in this thread
+      vector_future = self.search_executor.submit(self.vector_stage, query, k)
+      (keyword_docs, keyword_filenames, keyword_row_ids), keyword_ms = timed(self.keyword_search, query, k)
+      (vector_docs, vector_filenames, vector_row_ids), embed_ms, query_ms = vector_future.result()
+      candidates_ms = (time.perf_counter() - start) * 1000
+      self.observe_stage("candidates", candidates_ms)
+      print(f"Keyword Search: {keyword_ms:.1f} ms, Vector Search: {embed_ms:.1f} ms embedding + {query_ms:.1f} ms query, both stages: {candidates_ms:.1f} ms")
       all_filenames = keyword_filenames.union(vector_filenames)
-      print("Reranking...")
-      reranked_docs = self.rerank(query, all_docs, k)
+      fused_docs, fused_row_ids, fused_counts = self.fuse(keyword_docs, keyword_row_ids, vector_docs, vector_row_ids)
+      if mode == "rerank" or (mode == "auto" and self.is_ambiguous(fused_counts, k)):
+        reranked_docs, rerank_ms = timed(self.rerank, query, fused_docs, fused_row_ids, k)
+        self.observe_stage("rerank", rerank_ms)
+        print(f"Reranking: {rerank_ms:.1f} ms, Total: {(time.perf_counter() - start) * 1000:.1f} ms")
+      else:
+        reranked_docs = fused_docs[:k]
+        print(f"Rank Fusion ({mode}), Total: {(time.perf_counter() - start) * 1000:.1f} ms")
+      self.observe_stage("total", (time.perf_counter() - start) * 1000)
     else:
       reranked_docs = []
       all_filenames = set()
     return reranked_docs, all_filenames
 
+
+  def search_batch(self, queries, k=3, mode="rerank"):
+    # Same as search for a list of queries, with each stage batched across the queries
+    if mode not in search_modes:
+      raise ValueError(f"Unknown search mode {mode}, expected one of {search_modes}")
+    if len(self.corpus_dict) == 0 or len(queries) == 0:
+      return [([], set()) for _ in queries]
+    print(f"Batch Search ({len(queries)} queries)...")
+    start = time.perf_counter()
+    keyword_results = self.keyword_search_batch(queries, k)
+    vector_results = self.vector_search_batch(queries, k)
+    reranked_docs_list = []
+    filenames_list = []
+    rerank_positions = [] # Positions of the queries sent to the reranker
+    for (keyword_docs, keyword_filenames, keyword_row_ids), (vector_docs, vector_filenames, vector_row_ids) in zip(keyword_results, vector_results):
+      fused_docs, fused_row_ids, fused_counts = self.fuse(keyword_docs, keyword_row_ids, vector_docs, vector_row_ids)
+      if mode == "rerank" or (mode == "auto" and self.is_ambiguous(fused_counts, k)):
+        rerank_positions.append((len(reranked_docs_list), fused_docs, fused_row_ids))
+      reranked_docs_list.append(fused_docs[:k])
+      filenames_list.append(keyword_filenames.union(vector_filenames))
+    if len(rerank_positions) > 0:
+      print(f"Reranking {len(rerank_positions)} of {len(queries)} queries...")
+      reranked, rerank_ms = timed(self.rerank_batch, [queries[i] for i, _, _ in rerank_positions], [docs for _, docs, _ in rerank_positions],
+                                  [row_ids for _, _, row_ids in rerank_positions], k)
+      self.observe_stage("rerank", rerank_ms, "batch")
+      for (i, _, _), reranked_docs in zip(rerank_positions, reranked):
+        reranked_docs_list[i] = reranked_docs
+    self.observe_stage("total", (time.perf_counter() - start) * 1000, "batch")
+    return list(zip(reranked_docs_list, filenames_list))
+
     
+  def collect_metrics(self):
+    # Corpus size, cache and model gauges read at every scrape of /metrics
+    with self.index_lock:
+      files = len(self.corpus_dict)
+      unique_chunks = len(self.keyword_index)
+      stored_chunks = sum(len(chunk_ids) for chunk_ids in self.chunk_ids.values())
+      vocabulary_size = self.keyword_index.vocabulary_size()
+      corpus_version = self.corpus_version
+    families = [
+      ("retrieval_corpus_files", "gauge", "Files in the corpus", [({}, files)]),
+      ("retrieval_corpus_chunks", "gauge", "Chunks in the corpus, stored counts a chunk once for every file containing it",
+       [({"kind": "unique"}, unique_chunks), ({"kind": "stored"}, stored_chunks)]),
+      ("retrieval_bm25_vocabulary_size", "gauge", "Tokens found in at least one chunk of the BM25 index", [({}, vocabulary_size)]),
+      ("retrieval_corpus_version", "gauge", "Version of the corpus in the keyword index", [({}, corpus_version)]),
+    ]
+    cache_stats = [(name, model.cache.stats()) for name, model in [("embedding", self.embedding_model), ("rerank", self.reranker)]
+                   if getattr(model, "cache", None) is not None]
+    families.extend([
+      ("retrieval_cache_hits_total", "counter", "Cache hits", [({"cache": name}, stats["hits"]) for name, stats in cache_stats]),
+      ("retrieval_cache_misses_total", "counter", "Cache misses", [({"cache": name}, stats["misses"]) for name, stats in cache_stats]),
+      ("retrieval_cache_hit_ratio", "gauge", "Cache hits over lookups since startup",
+       [({"cache": name}, stats["hits"] / max(stats["hits"] + stats["misses"], 1)) for name, stats in cache_stats]),
+      ("retrieval_cache_entries", "gauge", "Entries in the cache", [({"cache": name}, stats["entries"]) for name, stats in cache_stats]),
+    ])
+    if self.model_manager is not None:
+      stats = self.model_manager.stats()
+      families.extend([
+        ("retrieval_models_loaded", "gauge", "Image caption and speech recognition models loaded", [({"model": name}, 1) for name in stats["loaded"]]),
+        ("retrieval_model_memory_bytes", "gauge", "Memory used by the loaded models", [({}, stats["memory_used"])]),
+        ("retrieval_model_loads_total", "counter", "Model loads", [({}, stats["loads"])]),
+        ("retrieval_model_evictions_total", "counter", "Model evictions", [({}, stats["evictions"])]),
+      ])
+    return families
+
+
   def load_files(self):
-    results = self.conn.execute('SELECT file_id, filename, SUM(length) FROM vectordb GROUP BY file_id, filename').fetchall()
+    # Sizes are stored with the file when it is ingested
+    with self.pool.connection() as conn:
+      results = conn.execute('SELECT file_id, filename, size FROM files WHERE ready ORDER BY created_at, file_id').fetchall()
     filesizes = []
     for file_id, filename, filesize in results:
       filesizes.append({"id": file_id, "name": filename, "size": filesize})
     return filesizes
 
 
-hybrid_search = HybridSearch(embedding_model=embedding_model, embedding_dim=embedding_model.embedding_dims, reranker=reranker)
\ No newline at end of file
+hybrid_search = HybridSearch(embedding_model=embedding_model, embedding_dim=embedding_model.embedding_dims, reranker=reranker,
+                             host=os.getenv("DB_HOST", "db"), port=os.getenv("DB_PORT", "5432"), dbname=os.getenv("DB_NAME", "database"),
+                             user=os.getenv("DB_USER", "postgres"), password=os.getenv("DB_PASSWORD", "admin"),
+                             vector_index=os.getenv("VECTOR_INDEX", "hnsw"), vector_distance=os.getenv("VECTOR_DISTANCE", "ip"),
+                             vector_type=os.getenv("VECTOR_TYPE", "vector"), vector_quantization=os.getenv("VECTOR_QUANTIZATION", "none"),
+                             rescore_factor=int(os.getenv("VECTOR_RESCORE_FACTOR", "4")),
+                             ef_search=int(os.getenv("HNSW_EF_SEARCH", "40")), probes=int(os.getenv("IVFFLAT_PROBES", "10")),
+                             pool_min_size=int(os.getenv("DB_POOL_MIN_SIZE", "1")), pool_max_size=int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+                             snapshot_dir=os.getenv("KEYWORD_INDEX_SNAPSHOT_DIR", "/retrieval-data/keyword_index") or None, snapshot_delay=float(os.getenv("KEYWORD_INDEX_SNAPSHOT_DELAY", "60")),
+                             search_threads=int(os.getenv("SEARCH_THREADS", "8")), model_manager=model_manager, document_parser=document_parser,
+                             chunkers=chunkers, default_chunker=os.getenv("DEFAULT_CHUNKER", "character"),
+                             embed_batch_size=int(os.getenv("EMBED_BATCH_SIZE", "64")), page_batch_size=int(os.getenv("PDF_PAGE_BATCH_SIZE", "10")),
+                             metrics=metrics, lazy=True)
\ No newline at end of file
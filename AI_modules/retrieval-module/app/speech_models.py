@@ -1,3 +1,5 @@
+import subprocess
+import numpy as np
 import torch
 from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
 
@@ -11,20 +13,153 @@ else:
 
 
 class SpeechRecognitionModel():
-  def __init__(self, model_str: str="openai/whisper-base.en"):
+  def __init__(self, model_str: str="openai/whisper-base.en", sampling_rate: int=16000, batch_size: int=8, block_seconds: float=30,
+               vad_threshold_db: float=-45, vad_frame_seconds: float=0.03, min_silence_seconds: float=0.5, vad_padding_seconds: float=0.2, max_segment_seconds: float=30,
+               cut_search_seconds: float=5):
     self.pipe = pipeline(
       "automatic-speech-recognition",
       model=model_str,
       chunk_length_s=30,
       device=device,
     )
-  
-  def generate(self, filepath: str):
+    self.sampling_rate = sampling_rate
+    self.batch_size = batch_size # Speech segments transcribed together
+    self.block_samples = int(block_seconds * sampling_rate) # Samples decoded from the file at a time
+    # Voice activity detection: frames quieter than vad_threshold_db (dBFS) are silence, silences shorter than
+    # min_silence_seconds are kept and vad_padding_seconds of audio is kept around speech
+    self.vad_threshold_db = vad_threshold_db
+    self.frame_samples = int(vad_frame_seconds * sampling_rate)
+    self.min_silence_frames = int(min_silence_seconds / vad_frame_seconds)
+    self.padding_frames = int(vad_padding_seconds / vad_frame_seconds)
+    self.max_segment_samples = int(max_segment_seconds * sampling_rate) # Whisper transcribes 30s windows
+    # Speech running longer than a segment is cut at the quietest frame of the last cut_search_seconds of the segment
+    self.cut_search_frames = max(int(cut_search_seconds / vad_frame_seconds), 1)
+
+  def memory_footprint(self):
+    # Bytes used by the model weights
+    return sum(tensor.numel() * tensor.element_size() for tensor in list(self.pipe.model.parameters()) + list(self.pipe.model.buffers()))
+
+  def read_audio(self, filepath: str):
+    # Decode the file with ffmpeg to mono float32 at the model sampling rate, yielding blocks of block_samples
+    # so that long recordings are never fully decoded in memory
+    process = subprocess.Popen(["ffmpeg", "-nostdin", "-loglevel", "error", "-i", filepath, "-ac", "1", "-ar", str(self.sampling_rate), "-f", "f32le", "-"],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     try:
-      prediction = self.pipe(filepath, batch_size=8)["text"]
-      print("Generated speech: ", prediction)
+      while True:
+        data = process.stdout.read(self.block_samples * 4)
+        if len(data) == 0:
+          break
+        yield np.frombuffer(data[:len(data) - len(data) % 4], dtype=np.float32)
+      if process.wait() != 0:
+        raise RuntimeError(f"ffmpeg could not decode the audio: {process.stderr.read().decode(errors='ignore')}")
+    finally:
+      if process.poll() is None:
+        process.kill()
+      process.stdout.close()
+      process.stderr.close()
+
+  def speech_mask(self, audio):
+    # Returns a boolean mask of the frames to keep
+    num_frames = int(np.ceil(len(audio) / self.frame_samples))
+    frames = np.zeros(num_frames * self.frame_samples, dtype=np.float32)
+    frames[:len(audio)] = audio
+    rms = np.sqrt(np.mean(frames.reshape(num_frames, self.frame_samples) ** 2, axis=1))
+    voiced = 20 * np.log10(rms + 1e-10) > self.vad_threshold_db
+    # Keep padding frames around speech
+    keep = voiced.copy()
+    for shift in range(1, self.padding_frames + 1):
+      keep[shift:] |= voiced[:-shift]
+      keep[:-shift] |= voiced[shift:]
+    # Keep short pauses inside speech
+    silent_start = None
+    for i in range(num_frames + 1):
+      if i < num_frames and not keep[i]:
+        if silent_start is None:
+          silent_start = i
+      elif silent_start is not None:
+        if i - silent_start < self.min_silence_frames:
+          keep[silent_start:i] = True
+        silent_start = None
+    return keep
+
+  def quiet_cut(self, audio):
+    # Sample in the middle of the quietest frame among the last cut_search_frames frames of the audio
+    num_frames = len(audio) // self.frame_samples
+    search_frames = min(self.cut_search_frames, num_frames)
+    frames = audio[(num_frames - search_frames) * self.frame_samples:num_frames * self.frame_samples].reshape(search_frames, self.frame_samples)
+    quietest = int(np.argmin(np.mean(frames ** 2, axis=1)))
+    return (num_frames - search_frames + quietest) * self.frame_samples + self.frame_samples // 2
+
+  def speech_runs(self, blocks):
+    # Yields the runs of speech between long silences, runs longer than max_segment_samples are yielded in pieces of
+    # at most max_segment_samples cut at a quiet frame
+    run = []
+    run_samples = 0
+    for audio in blocks:
+      keep = self.speech_mask(audio)
+      # Runs of kept frames as (start frame, end frame)
+      edges = np.flatnonzero(np.diff(np.concatenate([[0], keep.astype(np.int8), [0]])))
+      for start, end in zip(edges[::2], edges[1::2]):
+        # A run carried over from the previous block ends if this block starts with silence
+        if start > 0 and run_samples > 0:
+          yield np.concatenate(run)
+          run = []
+          run_samples = 0
+        speech = audio[start * self.frame_samples:end * self.frame_samples]
+        run.append(speech)
+        run_samples += len(speech)
+        while run_samples > self.max_segment_samples:
+          # Cut between words and carry the rest of the run over to the next piece
+          run_audio = np.concatenate(run)
+          cut = self.quiet_cut(run_audio[:self.max_segment_samples])
+          yield run_audio[:cut]
+          run = [run_audio[cut:]]
+          run_samples = len(run_audio) - cut
+        # The run continues into the next block only if the speech reaches the end of this block
+        if end < len(keep) and run_samples > 0:
+          yield np.concatenate(run)
+          run = []
+          run_samples = 0
+    if run_samples > 0:
+      yield np.concatenate(run)
+
+  def speech_segments(self, blocks):
+    # Yields segments of at most max_segment_samples packing consecutive runs of speech without the silences between them,
+    # a segment is cut at the silence before the run that does not fit, or at a quiet frame within a run longer than a segment
+    segment = []
+    segment_samples = 0
+    for run in self.speech_runs(blocks):
+      if segment_samples + len(run) > self.max_segment_samples:
+        yield np.concatenate(segment)
+        segment = []
+        segment_samples = 0
+      segment.append(run)
+      segment_samples += len(run)
+    if segment_samples > 0:
+      yield np.concatenate(segment)
+
+  def generate_segments(self, filepath: str):
+    # Transcribes the speech segments of the file in batches, yielding the text of each segment as soon as it is transcribed
+    try:
+      batch = []
+      speech_samples = 0
+      for segment in self.speech_segments(self.read_audio(filepath)):
+        batch.append({"raw": segment, "sampling_rate": self.sampling_rate})
+        speech_samples += len(segment)
+        if len(batch) == self.batch_size:
+          for prediction in self.pipe(batch, batch_size=self.batch_size):
+            yield prediction["text"]
+          batch = []
+      if len(batch) > 0:
+        for prediction in self.pipe(batch, batch_size=self.batch_size):
+          yield prediction["text"]
+      print(f"Transcribed {speech_samples / self.sampling_rate:.0f} s of speech")
     except Exception as e:
       print("Error generating speech")
       print(e)
-      return None
-    return prediction
\ No newline at end of file
+      raise
+
+  def generate(self, filepath: str):
+    speech = " ".join(text.strip() for text in self.generate_segments(filepath))
+    print("Generated speech: ", speech)
+    return speech
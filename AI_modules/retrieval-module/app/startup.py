@@ -0,0 +1,70 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Startup():
+  # Loads the components of the server (models, search index) concurrently in background threads
+  # so that the server accepts requests right away, /ready reports when every component is loaded
+  def __init__(self, loaders: dict, metrics=None):
+    self.loaders = loaders # Component name -> function loading it
+    self.status = {name: "pending" for name in loaders} # pending, loading, ready or failed
+    self.errors = dict()
+    self.seconds = dict() # Component name -> seconds the component took to load
+    self.lock = threading.Lock()
+    if metrics is not None:
+      metrics.register_collector(self.collect_metrics)
+
+
+  def start(self):
+    executor = ThreadPoolExecutor(max_workers=max(len(self.loaders), 1), thread_name_prefix="startup")
+    for name, loader in self.loaders.items():
+      executor.submit(self.run, name, loader)
+    # The threads exit once their component is loaded
+    executor.shutdown(wait=False)
+    return
+
+
+  def run(self, name: str, loader):
+    with self.lock:
+      self.status[name] = "loading"
+    start = time.perf_counter()
+    try:
+      loader()
+    except Exception as e:
+      print("Error in loading: ", name)
+      print(e)
+      with self.lock:
+        self.status[name] = "failed"
+        self.errors[name] = str(e)
+      return
+    with self.lock:
+      self.status[name] = "ready"
+      self.seconds[name] = time.perf_counter() - start
+    print(f"Loaded {name} in {self.seconds[name]:.1f}s")
+    return
+
+
+  def ready(self):
+    with self.lock:
+      return all(status == "ready" for status in self.status.values())
+
+
+  def failed(self):
+    with self.lock:
+      return any(status == "failed" for status in self.status.values())
+
+
+  def stats(self):
+    with self.lock:
+      return {name: {"status": status, "seconds": self.seconds.get(name), "error": self.errors.get(name)} for name, status in self.status.items()}
+
+
+  def collect_metrics(self):
+    with self.lock:
+      return [
+        ("retrieval_component_ready", "gauge", "Whether each component of the server has been loaded",
+         [({"component": name}, int(status == "ready")) for name, status in self.status.items()]),
+        ("retrieval_component_load_seconds", "gauge", "Time each component took to load at startup",
+         [({"component": name}, seconds) for name, seconds in self.seconds.items()]),
+      ]
@@ -0,0 +1,133 @@
+# Checks an inference backend of the embedding model and reranker (embedding_models.inference_backends) against
+# the flag backend and compares their speed
+# Embeddings are compared by cosine similarity and by the agreement of the passages they retrieve for each query,
+# reranker scores by their rank correlation and the agreement of the top-k on the candidates of each query
+# Exits with status 1 if the backend falls below --min-cosine or --min-agreement
+# Example: python benchmarks/backend_report.py --backend int8 --threads 4 --files notes.pdf notes.md
+import argparse
+import os
+import re
+import sys
+import time
+import numpy as np
+from documents import load_documents
+
+app_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+
+def sample_queries(rng, passages, num_queries):
+  # Sentences of the passages are used as queries
+  sentences = list(dict.fromkeys(sentence.strip() for passage in passages for sentence in re.split(r"(?<=[.!?])\s+", passage) if len(sentence.split()) >= 6))
+  return [sentences[i] for i in rng.choice(len(sentences), min(num_queries, len(sentences)), replace=False)]
+
+
+def timed_encode(model, texts):
+  model.encode(texts[:8]) # Warm up
+  start = time.perf_counter()
+  embeddings = np.asarray(model.encode(texts), dtype=np.float32)
+  return embeddings, time.perf_counter() - start
+
+
+def timed_scores(model, pairs):
+  model.compute_score(pairs[:8]) # Warm up
+  start = time.perf_counter()
+  scores = np.asarray(model.compute_score(pairs), dtype=np.float32)
+  return scores, time.perf_counter() - start
+
+
+def top_k_agreement(reference_scores, scores, k):
+  # Fraction of the reference top-k also in the top-k of the backend, averaged over the rows
+  reference_top = np.argsort(-reference_scores, axis=1)[:, :k]
+  top = np.argsort(-scores, axis=1)[:, :k]
+  return np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(reference_top.tolist(), top.tolist())])
+
+
+def rank_correlation(reference_scores, scores):
+  # Spearman correlation of each row with more than one score, averaged over the rows
+  if reference_scores.shape[1] < 2:
+    return 1.0
+  reference_ranks = np.argsort(np.argsort(reference_scores, axis=1), axis=1).astype(np.float64)
+  ranks = np.argsort(np.argsort(scores, axis=1), axis=1).astype(np.float64)
+  reference_ranks -= reference_ranks.mean(axis=1, keepdims=True)
+  ranks -= ranks.mean(axis=1, keepdims=True)
+  return np.mean(np.sum(reference_ranks * ranks, axis=1) / np.sqrt(np.sum(reference_ranks ** 2, axis=1) * np.sum(ranks ** 2, axis=1)))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--backend", default="int8", help="Backend checked against the flag backend")
+  parser.add_argument("--files", nargs="+", required=True, help="PDF, markdown or text files the passages and queries are taken from")
+  parser.add_argument("--chunker", default="token", help="Chunker splitting the files into passages")
+  parser.add_argument("--queries", type=int, default=100)
+  parser.add_argument("--k", type=int, default=3)
+  parser.add_argument("--candidates", type=int, default=10, help="Passages reranked for each query")
+  parser.add_argument("--threads", type=int, default=0, help="Torch CPU threads (INFERENCE_THREADS), 0 keeps the default")
+  parser.add_argument("--min-cosine", type=float, default=0.99, help="Lowest mean cosine similarity to the flag embeddings that passes")
+  parser.add_argument("--min-agreement", type=float, default=0.9, help="Lowest top-k agreement with the flag backend that passes")
+  args = parser.parse_args()
+
+  # The module-level models are the flag reference
+  os.environ.update({"EMBEDDING_BACKEND": "flag", "RERANKER_BACKEND": "flag", "EMBEDDING_CACHE_BYTES": "0", "RERANK_CACHE_ENTRIES": "0",
+                     "INFERENCE_THREADS": str(args.threads)})
+  sys.path.insert(0, app_dir)
+  import embedding_models
+  from chunkers import chunkers
+  embedding_model = embedding_models.EmbeddingModel(cache_bytes=0, backend=args.backend)
+  reranker = embedding_models.RerankerModel(cache_entries=0, backend=args.backend)
+  reference_embedding_model = embedding_models.embedding_model.load()
+  reference_reranker = embedding_models.reranker.load()
+
+  rng = np.random.default_rng(0)
+  passages = list(dict.fromkeys(passage for document in load_documents(args.files) for passage in chunkers[args.chunker].split(document)))
+  queries = sample_queries(rng, passages, args.queries)
+  print(f"{len(passages)} passages, {len(queries)} queries, {args.backend} backend, {args.threads or 'default'} threads")
+  print()
+
+  # Embeddings
+  reference_passage_embeddings, reference_passage_time = timed_encode(reference_embedding_model, passages)
+  passage_embeddings, passage_time = timed_encode(embedding_model.embedding_model, passages)
+  reference_query_embeddings, reference_query_time = timed_encode(reference_embedding_model, queries)
+  query_embeddings, query_time = timed_encode(embedding_model.embedding_model, queries)
+  # Both backends return normalized embeddings
+  cosines = np.concatenate([np.sum(reference_passage_embeddings * passage_embeddings, axis=1), np.sum(reference_query_embeddings * query_embeddings, axis=1)])
+  reference_similarities = reference_query_embeddings @ reference_passage_embeddings.T
+  similarities = query_embeddings @ passage_embeddings.T
+
+  # Reranker scores of the reference candidates of each query
+  candidates = np.argsort(-reference_similarities, axis=1)[:, :args.candidates]
+  pairs = [[query, passages[i]] for query, ids in zip(queries, candidates.tolist()) for i in ids]
+  reference_scores, reference_rerank_time = timed_scores(reference_reranker, pairs)
+  scores, rerank_time = timed_scores(reranker.reranker, pairs)
+  reference_scores = reference_scores.reshape(len(queries), -1)
+  scores = scores.reshape(len(queries), -1)
+
+  checks = [
+    ("embedding mean cosine", np.mean(cosines), args.min_cosine),
+    ("embedding min cosine", np.min(cosines), None),
+    (f"retrieval top-{args.k} agreement", top_k_agreement(reference_similarities, similarities, args.k), args.min_agreement),
+    ("retrieval top-1 agreement", top_k_agreement(reference_similarities, similarities, 1), None),
+    (f"rerank top-{args.k} agreement", top_k_agreement(reference_scores, scores, args.k), args.min_agreement),
+    ("rerank top-1 agreement", top_k_agreement(reference_scores, scores, 1), None),
+    ("rerank rank correlation", rank_correlation(reference_scores, scores), None),
+  ]
+  print(f"| {'check':<28} | value | threshold |")
+  print(f"|{'-' * 30}|{'-' * 7}|{'-' * 11}|")
+  for check, value, threshold in checks:
+    print(f"| {check:<28} | {value:.3f} | {'' if threshold is None else f'{threshold:.3f}':>9} |")
+  print()
+  print(f"| {'stage':<18} | flag /s | {args.backend + ' /s':>9} | speedup |")
+  print(f"|{'-' * 20}|{'-' * 9}|{'-' * 11}|{'-' * 9}|")
+  for stage, count, reference_time, backend_time in [("embed passages", len(passages), reference_passage_time, passage_time),
+                                                     ("embed queries", len(queries), reference_query_time, query_time),
+                                                     ("rerank pairs", len(pairs), reference_rerank_time, rerank_time)]:
+    print(f"| {stage:<18} | {count / reference_time:>7.1f} | {count / backend_time:>9.1f} | {reference_time / backend_time:>6.2f}x |")
+
+  failed = [check for check, value, threshold in checks if threshold is not None and value < threshold]
+  if len(failed) > 0:
+    print()
+    print(f"Failed: {', '.join(failed)}")
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,113 @@
+# Index size, ingestion time and retrieval hit rate of the chunkers selectable per upload (chunkers.chunkers)
+# Loads the embedding model of the retrieval module, so run it in the retrieval module's environment
+# Queries are sentences of the documents with some words dropped, a query is a hit if a top-k chunk contains its sentence
+# Example: python benchmarks/chunking_report.py --files notes.pdf slides.pdf --queries 200
+import argparse
+import os
+import re
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from embedding_models import embedding_model
+from chunkers import chunkers
+from keyword_index import KeywordIndex
+from documents import load_documents
+
+
+def generate_documents(rng, num_documents, sections, sentences_per_section):
+  # Markdown notes with headed sections, each section draws its sentences from its own topic vocabulary
+  vocabulary = [f"term{i}" for i in range(5000)]
+  documents = []
+  for d in range(num_documents):
+    parts = [f"# Document {d}"]
+    for s in range(sections):
+      topic = rng.choice(len(vocabulary), 40, replace=False)
+      sentences = [" ".join(vocabulary[i] for i in rng.choice(topic, rng.integers(8, 20))).capitalize() + "." for _ in range(sentences_per_section)]
+      parts.append(f"## Section {d}.{s}\n\n" + " ".join(sentences))
+    documents.append("\n\n".join(parts))
+  return documents
+
+
+def sample_queries(rng, documents, num_queries, drop=0.3):
+  # Returns (query, sentence) pairs, the query is the sentence with a fraction of its words dropped
+  sentences = [sentence.strip() for document in documents for line in document.splitlines() if not line.startswith("#")
+               for sentence in re.split(r"(?<=[.!?])\s+", line) if len(sentence.split()) >= 8]
+  queries = []
+  for i in rng.choice(len(sentences), min(num_queries, len(sentences)), replace=False):
+    words = sentences[i].split()
+    keep = rng.random(len(words)) >= drop
+    queries.append((" ".join(word for word, kept in zip(words, keep) if kept), sentences[i]))
+  return queries
+
+
+def top_k(scores, k):
+  ids = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+  return ids[np.argsort(-scores[ids], kind="stable")].tolist()
+
+
+def fuse(keyword_ids, vector_ids, k, rrf_k=60):
+  # Reciprocal rank fusion as in HybridSearch.fuse
+  scores = {}
+  for ids in [keyword_ids, vector_ids]:
+    for rank, chunk_id in enumerate(ids):
+      scores[chunk_id] = scores.get(chunk_id, 0) + 1 / (rrf_k + rank + 1)
+  return sorted(scores, key=lambda chunk_id: scores[chunk_id], reverse=True)[:k]
+
+
+def hit_rate(results, chunks, queries):
+  hits = sum(any(sentence in chunks[chunk_id] for chunk_id in ids) for ids, (query, sentence) in zip(results, queries))
+  return hits / len(queries)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--files", nargs="*", default=None, help="PDF or text files to chunk, synthetic markdown notes are used if none are given")
+  parser.add_argument("--documents", type=int, default=20, help="Number of synthetic documents")
+  parser.add_argument("--sections", type=int, default=8)
+  parser.add_argument("--sentences", type=int, default=30, help="Sentences per synthetic section")
+  parser.add_argument("--queries", type=int, default=200)
+  parser.add_argument("--k", type=int, default=3)
+  parser.add_argument("--chunkers", nargs="+", choices=list(chunkers), default=list(chunkers))
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(0)
+  documents = load_documents(args.files) if args.files else generate_documents(rng, args.documents, args.sections, args.sentences)
+  queries = sample_queries(rng, documents, args.queries)
+  source_chars = sum(len(document) for document in documents)
+  query_embeddings = np.asarray(embedding_model.encode([query for query, sentence in queries]))
+  print(f"{len(documents)} documents, {source_chars} characters, {len(queries)} queries, k={args.k}")
+  print()
+  print(f"| {'chunker':<10} | chunks | stored/source | truncated | index MB | chunk s | embed s | bm25 s | hit@{args.k} bm25 | hit@{args.k} vector | hit@{args.k} fused |")
+  print(f"|{'-' * 12}|{'-' * 8}|{'-' * 15}|{'-' * 11}|{'-' * 10}|{'-' * 9}|{'-' * 9}|{'-' * 8}|{'-' * 12}|{'-' * 14}|{'-' * 13}|")
+
+  for name in args.chunkers:
+    start = time.perf_counter()
+    chunks = [chunk for document in documents for chunk in chunkers[name].split(document)]
+    chunk_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    chunk_embeddings = np.asarray(embedding_model.encode(chunks))
+    embed_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    keyword_index = KeywordIndex()
+    keyword_index.add(chunks)
+    bm25_time = time.perf_counter() - start
+
+    # Chunks longer than the embedding window lose their tail when embedded
+    truncated = sum(len(embedding_model.tokenizer.tokenize(chunk)) > embedding_model.max_tokens - 2 for chunk in chunks)
+    stored_chars = sum(len(chunk) for chunk in chunks)
+    index_mb = (stored_chars + chunk_embeddings.nbytes) / 2**20
+
+    keyword_results = [ids for ids, scores in keyword_index.retrieve_batch([query for query, sentence in queries], args.k)]
+    vector_results = [top_k(chunk_embeddings @ query_embedding, args.k) for query_embedding in query_embeddings]
+    fused_results = [fuse(keyword_ids, vector_ids, args.k) for keyword_ids, vector_ids in zip(keyword_results, vector_results)]
+
+    print(f"| {name:<10} | {len(chunks):>6} | {stored_chars / source_chars:>13.2f} | {truncated:>9} | {index_mb:>8.1f} | {chunk_time:>7.2f} | {embed_time:>7.2f} | {bm25_time:>6.2f} "
+          f"| {hit_rate(keyword_results, chunks, queries):>10.3f} | {hit_rate(vector_results, chunks, queries):>12.3f} | {hit_rate(fused_results, chunks, queries):>11.3f} |")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,16 @@
+# Documents shared by the benchmark scripts, which import it from the benchmarks directory they run from
+
+
+def load_documents(files):
+  # Text and markdown files are read as is, other files are converted to markdown as on upload
+  import pymupdf
+  import pymupdf4llm
+  documents = []
+  for path in files:
+    if path.endswith((".txt", ".md")):
+      with open(path, encoding="utf-8", errors="ignore") as f:
+        documents.append(f.read())
+      continue
+    with pymupdf.open(path) as doc:
+      documents.append(pymupdf4llm.to_markdown(doc))
+  return documents
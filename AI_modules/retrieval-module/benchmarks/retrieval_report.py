@@ -0,0 +1,289 @@
+# Latency, ingestion throughput, memory and recall@k report of HybridSearch
+# Corpora of the given sizes are generated (or loaded with --corpus and --pairs) and ingested through add_documents,
+# then the labelled queries are replayed through keyword_search, vector_search, rerank and search
+# Runs on CPU against a scratch database of a local Postgres with pgvector, the database is created and dropped by the script
+# --stub-models replaces the embedding model and reranker with hashed bag-of-words stand-ins so that only the retrieval code
+# and postgres are measured, without it the models of the retrieval module are loaded
+# Example: python benchmarks/retrieval_report.py --host localhost --sizes 1000 10000 100000 --stub-models
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import types
+import zlib
+import numpy as np
+import psycopg
+
+app_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+
+class StubEmbeddingModel():
+  # Hashed bag of words, normalized like the bge embeddings
+  embedding_dims = 768
+
+  def __init__(self):
+    self.tokenizer = None
+    self.max_tokens = 512
+
+  def embed(self, text: str):
+    embedding = np.zeros(self.embedding_dims, dtype=np.float32)
+    for token in text.lower().split():
+      embedding[zlib.crc32(token.encode()) % self.embedding_dims] += 1
+    return embedding / max(np.linalg.norm(embedding), 1e-6)
+
+  def encode(self, query):
+    if isinstance(query, str):
+      return self.embed(query)
+    return np.stack([self.embed(text) for text in query]) if len(query) > 0 else np.zeros((0, self.embedding_dims), dtype=np.float32)
+
+  def encode_batch(self, queries: list):
+    return [self.embed(query) for query in queries]
+
+
+class StubReranker():
+  # Fraction of the query words found in the document
+  def score_pairs(self, queries: list, docs: list, chunk_ids: list):
+    scores = []
+    for query, doc in zip(queries, docs):
+      query_words = set(query.lower().split())
+      scores.append(len(query_words & set(doc.lower().split())) / max(len(query_words), 1))
+    return scores
+
+  def score(self, query: str, docs: list, chunk_ids: list):
+    return self.score_pairs([query] * len(docs), docs, chunk_ids)
+
+  def invalidate(self, chunk_ids: list):
+    return
+
+
+class StubChunker():
+  # Corpora are ingested as chunks, so the chunkers are never used
+  def split(self, document: str):
+    return [document]
+
+
+def install_stub_models():
+  # Replace the model modules before retrieval_model imports them
+  embedding_models = types.ModuleType("embedding_models")
+  embedding_models.embedding_model = StubEmbeddingModel()
+  embedding_models.reranker = StubReranker()
+  sys.modules["embedding_models"] = embedding_models
+  chunkers = types.ModuleType("chunkers")
+  chunkers.chunkers = {"character": StubChunker()}
+  sys.modules["chunkers"] = chunkers
+
+
+def generate_vocabulary(rng, size):
+  # Pronounceable words so that the real tokenizers split them like ordinary words
+  syllables = [consonant + vowel for consonant in "bdfgklmnprstvz" for vowel in "aeiou"]
+  words = set()
+  while len(words) < size:
+    words.add("".join(syllables[i] for i in rng.integers(0, len(syllables), rng.integers(2, 4))))
+  return sorted(words)
+
+
+def generate_corpus(rng, num_chunks, chunks_per_file, num_queries, chunk_words=80, query_words=6, topic_size=200):
+  # Chunks draw most of their words from a topic shared with about 50 other chunks and the rest from the whole
+  # vocabulary with Zipf-like frequencies, each query is a few words of one chunk, which is its relevant chunk
+  vocabulary = np.array(generate_vocabulary(rng, 20000))
+  frequencies = 1 / np.arange(1, len(vocabulary) + 1)
+  frequencies /= frequencies.sum()
+  topics = [rng.choice(len(vocabulary), topic_size, replace=False) for _ in range(max(num_chunks // 50, 1))]
+  topic_words = int(0.7 * chunk_words)
+  texts = []
+  for i in range(num_chunks):
+    words = np.concatenate([rng.choice(topics[i % len(topics)], topic_words), rng.choice(len(vocabulary), chunk_words - topic_words, p=frequencies)])
+    rng.shuffle(words)
+    texts.append(" ".join(vocabulary[words]))
+  files = [(f"file_{start // chunks_per_file}.pdf", texts[start:start + chunks_per_file]) for start in range(0, num_chunks, chunks_per_file)]
+  pairs = []
+  for i in rng.choice(num_chunks, min(num_queries, num_chunks), replace=False):
+    words = texts[i].split()
+    pairs.append((" ".join(words[j] for j in rng.choice(len(words), query_words, replace=False)), texts[i]))
+  return files, pairs
+
+
+def load_corpus(corpus_path, pairs_path):
+  # corpus_path: JSON lines of {"filename", "text"} chunks, pairs_path: JSON lines of {"query", "text"} with the text of the relevant chunk
+  files = {}
+  with open(corpus_path) as f:
+    for line in f:
+      chunk = json.loads(line)
+      files.setdefault(chunk["filename"], []).append(chunk["text"])
+  with open(pairs_path) as f:
+    pairs = [(pair["query"], pair["text"]) for pair in map(json.loads, f)]
+  return list(files.items()), pairs
+
+
+def rss_bytes():
+  # Resident memory of this process, postgres runs in its own processes
+  with open("/proc/self/statm") as f:
+    return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def replay(fn, queries, quiet=True):
+  # Returns the results of fn for each query and the latency of each call in milliseconds
+  results = []
+  latencies = []
+  with contextlib.redirect_stdout(open(os.devnull, "w") if quiet else sys.stdout):
+    for query in queries:
+      start = time.perf_counter()
+      results.append(fn(query))
+      latencies.append((time.perf_counter() - start) * 1000)
+  return results, latencies
+
+
+def recall_at_k(docs_lists, pairs):
+  # Each query has one relevant chunk, so recall@k is the fraction of queries whose chunk is in the top-k
+  return sum(text in docs for docs, (query, text) in zip(docs_lists, pairs)) / len(pairs)
+
+
+def create_search(args, retrieval_model, conn):
+  # Every corpus is ingested into empty tables
+  conn.execute('DROP TABLE IF EXISTS vectordb, files, corpus_version')
+  return retrieval_model.HybridSearch(embedding_model=retrieval_model.embedding_model, embedding_dim=retrieval_model.embedding_model.embedding_dims,
+                                      reranker=retrieval_model.reranker, host=args.host, port=args.port, dbname=args.dbname, user=args.user,
+                                      password=args.password, corpus_dict=dict(), vector_index=args.index, vector_distance=args.distance,
+                                      vector_type=args.vector_type, vector_quantization=args.quantization, rescore_factor=args.rescore_factor,
+                                      search_threads=args.search_threads, model_manager=retrieval_model.model_manager,
+                                      document_parser=retrieval_model.document_parser, chunkers=retrieval_model.chunkers,
+                                      embed_batch_size=args.embed_batch_size)
+
+
+def run(args, retrieval_model, conn, files, pairs):
+  with contextlib.redirect_stdout(open(os.devnull, "w") if not args.verbose else sys.stdout):
+    search = create_search(args, retrieval_model, conn)
+  try:
+    num_chunks = sum(len(corpus) for filename, corpus in files)
+    rss_before = rss_bytes()
+    # Ingestion
+    file_latencies = []
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, "w") if not args.verbose else sys.stdout):
+      for filename, corpus in files:
+        file_start = time.perf_counter()
+        search.add_documents(filename, corpus)
+        file_latencies.append((time.perf_counter() - file_start) * 1000)
+    ingest_time = time.perf_counter() - start
+    table_bytes = conn.execute("SELECT pg_total_relation_size('vectordb')").fetchone()[0]
+    rss_ingested = rss_bytes()
+
+    queries = [query for query, text in pairs]
+    replay(lambda query: search.search(query, args.k, "rerank"), queries[:args.warmup], not args.verbose)
+    # Stages
+    rows = []
+    keyword_results, latencies = replay(lambda query: search.keyword_search(query, args.k), queries, not args.verbose)
+    rows.append(("keyword_search", latencies, recall_at_k([docs for docs, filenames, row_ids in keyword_results], pairs)))
+    vector_results, latencies = replay(lambda query: search.vector_search(query, args.k), queries, not args.verbose)
+    rows.append(("vector_search", latencies, recall_at_k([docs for docs, filenames, row_ids in vector_results], pairs)))
+    # The reranker scores the fused candidates of the two stages above
+    stage_results = dict(zip(queries, zip(keyword_results, vector_results)))
+    fused, latencies = replay(lambda query: search.fuse(stage_results[query][0][0], stage_results[query][0][2], stage_results[query][1][0], stage_results[query][1][2]),
+                              queries, not args.verbose)
+    candidates = dict(zip(queries, fused))
+    rows.append(("rrf fusion", latencies, recall_at_k([fused_docs[:args.k] for fused_docs, fused_row_ids, fused_counts in fused], pairs)))
+    reranked, latencies = replay(lambda query: search.rerank(query, candidates[query][0], candidates[query][1], args.k), queries, not args.verbose)
+    rows.append(("rerank", latencies, recall_at_k(reranked, pairs)))
+    for mode in args.modes:
+      results, latencies = replay(lambda query: search.search(query, args.k, mode), queries, not args.verbose)
+      rows.append((f"search ({mode})", latencies, recall_at_k([docs for docs, filenames in results], pairs)))
+    rss_searched = rss_bytes()
+  finally:
+    search.pool.close()
+    search.search_executor.shutdown()
+
+  print(f"### {num_chunks} chunks, {len(files)} files, {len(queries)} queries, k={args.k}")
+  print()
+  print(f"Ingestion: {ingest_time:.1f} s, {num_chunks / ingest_time:.0f} chunks/s, "
+        f"p50 {np.percentile(file_latencies, 50):.0f} ms / p95 {np.percentile(file_latencies, 95):.0f} ms per file of {args.chunks_per_file} chunks")
+  print(f"Memory: vectordb table {table_bytes / 2**20:.0f} MiB, process RSS {rss_before / 2**20:.0f} MiB before ingestion, "
+        f"{rss_ingested / 2**20:.0f} MiB after ingestion, {rss_searched / 2**20:.0f} MiB after the queries")
+  print()
+  print(f"| {'stage':<16} | p50 ms | p95 ms | mean ms | recall@{args.k} |")
+  print(f"|{'-' * 18}|{'-' * 8}|{'-' * 8}|{'-' * 9}|{'-' * 10}|")
+  for stage, latencies, recall in rows:
+    print(f"| {stage:<16} | {np.percentile(latencies, 50):>6.2f} | {np.percentile(latencies, 95):>6.2f} | {np.mean(latencies):>7.2f} | {recall:>8.3f} |")
+  print()
+  return {"chunks": num_chunks, "files": len(files), "queries": len(queries), "ingest_seconds": ingest_time, "ingest_chunks_per_second": num_chunks / ingest_time,
+          "table_bytes": table_bytes, "rss_bytes": {"before_ingestion": rss_before, "after_ingestion": rss_ingested, "after_queries": rss_searched},
+          "stages": {stage: {"p50_ms": np.percentile(latencies, 50), "p95_ms": np.percentile(latencies, 95), "mean_ms": np.mean(latencies), f"recall@{args.k}": recall}
+                     for stage, latencies, recall in rows}}
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--host", default="localhost")
+  parser.add_argument("--port", default="5432")
+  parser.add_argument("--user", default="postgres")
+  parser.add_argument("--password", default="admin")
+  parser.add_argument("--admin-dbname", default="postgres", help="Existing database used to create and drop the scratch database")
+  parser.add_argument("--dbname", default="retrieval_report", help="Scratch database, dropped and recreated")
+  parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="Numbers of generated chunks")
+  parser.add_argument("--corpus", default=None, help="JSON lines of {\"filename\", \"text\"} chunks to ingest instead of generated corpora")
+  parser.add_argument("--pairs", default=None, help="JSON lines of {\"query\", \"text\"} labelled pairs for --corpus")
+  parser.add_argument("--chunks-per-file", type=int, default=100)
+  parser.add_argument("--queries", type=int, default=200)
+  parser.add_argument("--warmup", type=int, default=10)
+  parser.add_argument("--k", type=int, default=3)
+  parser.add_argument("--modes", nargs="+", default=["rerank", "rrf", "auto"])
+  parser.add_argument("--index", choices=["hnsw", "ivfflat", "none"], default="hnsw")
+  parser.add_argument("--distance", choices=["ip", "cosine", "l2"], default="ip")
+  parser.add_argument("--vector-type", choices=["vector", "halfvec"], default="vector")
+  parser.add_argument("--quantization", choices=["none", "binary"], default="none")
+  parser.add_argument("--rescore-factor", type=int, default=4, help="Hamming shortlist rows per returned row with binary quantization")
+  parser.add_argument("--search-threads", type=int, default=8)
+  parser.add_argument("--embed-batch-size", type=int, default=64)
+  parser.add_argument("--stub-models", action="store_true", help="Use hashed bag-of-words stand-ins for the embedding model and reranker")
+  parser.add_argument("--caches", action="store_true", help="Keep the query embedding and reranker caches enabled, repeated queries then hit them")
+  parser.add_argument("--output", default=None, help="Also write the results to this JSON file")
+  parser.add_argument("--verbose", action="store_true", help="Show the logs of the retrieval module")
+  args = parser.parse_args()
+  if (args.corpus is None) != (args.pairs is None):
+    parser.error("--corpus and --pairs must be given together")
+
+  admin_conn = psycopg.connect(f"host={args.host} port={args.port} dbname={args.admin_dbname} user={args.user} password={args.password}", autocommit=True)
+  admin_conn.execute(f'DROP DATABASE IF EXISTS {args.dbname}')
+  admin_conn.execute(f'CREATE DATABASE {args.dbname}')
+  admin_conn.close()
+  # retrieval_model creates its own HybridSearch on import (started by the server only), point it at the scratch database
+  os.environ.update({"DB_HOST": args.host, "DB_PORT": args.port, "DB_NAME": args.dbname, "DB_USER": args.user, "DB_PASSWORD": args.password,
+                     "KEYWORD_INDEX_SNAPSHOT_DIR": "", "PARSER_WORKERS": "0"})
+  if not args.caches:
+    os.environ.update({"EMBEDDING_CACHE_BYTES": "0", "RERANK_CACHE_ENTRIES": "0"})
+  if args.stub_models:
+    install_stub_models()
+  sys.path.insert(0, app_dir)
+  with contextlib.redirect_stdout(open(os.devnull, "w") if not args.verbose else sys.stdout):
+    import retrieval_model
+    # The models of the retrieval module load on first use, load them before anything is timed
+    if not args.stub_models:
+      retrieval_model.embedding_model.warm_up()
+      retrieval_model.reranker.warm_up()
+
+  conn = psycopg.connect(f"host={args.host} port={args.port} dbname={args.dbname} user={args.user} password={args.password}", autocommit=True)
+  results = []
+  try:
+    print(f"{'Stub' if args.stub_models else 'Retrieval module'} models, {args.index} index, {args.distance} distance, {args.vector_type} embeddings, "
+          f"{args.quantization} quantization, caches {'on' if args.caches else 'off'}")
+    print()
+    if args.corpus is not None:
+      files, pairs = load_corpus(args.corpus, args.pairs)
+      results.append(run(args, retrieval_model, conn, files, pairs))
+    else:
+      for size in args.sizes:
+        files, pairs = generate_corpus(np.random.default_rng(0), size, args.chunks_per_file, args.queries)
+        results.append(run(args, retrieval_model, conn, files, pairs))
+  finally:
+    conn.close()
+    admin_conn = psycopg.connect(f"host={args.host} port={args.port} dbname={args.admin_dbname} user={args.user} password={args.password}", autocommit=True)
+    admin_conn.execute(f'DROP DATABASE IF EXISTS {args.dbname} WITH (FORCE)')
+    admin_conn.close()
+  if args.output is not None:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
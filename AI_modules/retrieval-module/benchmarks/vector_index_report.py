@@ -0,0 +1,117 @@
+# Recall versus latency report for the pgvector ANN index used by HybridSearch.vector_search
+# Runs against a scratch table so the vectordb table is never touched
+# Example: python benchmarks/vector_index_report.py --host localhost --index hnsw --rows 20000
+import argparse
+import time
+import numpy as np
+import psycopg
+from pgvector.psycopg import register_vector
+
+
+# Same operators and operator classes as retrieval_model.vector_distances for float32 embeddings
+vector_distances = {
+  "ip": ("<#>", "vector_ip_ops"),
+  "cosine": ("<=>", "vector_cosine_ops"),
+  "l2": ("<->", "vector_l2_ops"),
+}
+
+
+def generate_embeddings(rng, rows, dim, clusters=50):
+  # Normalized vectors drawn around a set of topic centres, closer to real note embeddings than uniform noise
+  centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+  assignments = rng.integers(0, clusters, rows)
+  embeddings = centres[assignments] + 0.5 * rng.standard_normal((rows, dim)).astype(np.float32)
+  embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+  return embeddings
+
+
+def exact_neighbours(embeddings, queries, k):
+  # Embeddings are normalized so the inner product ranking is exact for every distance
+  scores = queries @ embeddings.T
+  return np.argsort(-scores, axis=1)[:, :k]
+
+
+def run_queries(conn, table, operator, queries, k):
+  latencies = []
+  results = []
+  for query in queries:
+    start = time.perf_counter()
+    rows = conn.execute(f'SELECT id FROM {table} ORDER BY embedding {operator} %s LIMIT {k}', (query,)).fetchall()
+    latencies.append((time.perf_counter() - start) * 1000)
+    results.append([row_id - 1 for (row_id,) in rows])
+  return results, latencies
+
+
+def recall_at_k(results, truth):
+  hits = sum(len(set(result) & set(expected)) for result, expected in zip(results, truth.tolist()))
+  return hits / truth.size
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--host", default="localhost")
+  parser.add_argument("--port", default="5432")
+  parser.add_argument("--dbname", default="database")
+  parser.add_argument("--user", default="postgres")
+  parser.add_argument("--password", default="admin")
+  parser.add_argument("--index", choices=["hnsw", "ivfflat"], default="hnsw")
+  parser.add_argument("--distance", choices=list(vector_distances), default="ip")
+  parser.add_argument("--rows", type=int, default=10000)
+  parser.add_argument("--dim", type=int, default=768)
+  parser.add_argument("--queries", type=int, default=100)
+  parser.add_argument("--k", type=int, default=3)
+  parser.add_argument("--hnsw-m", type=int, default=16)
+  parser.add_argument("--hnsw-ef-construction", type=int, default=64)
+  parser.add_argument("--ivfflat-lists", type=int, default=100)
+  parser.add_argument("--sweep", type=int, nargs="+", default=None, help="ef_search (HNSW) or probes (IVFFlat) values to report")
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(0)
+  operator, operator_class = vector_distances[args.distance]
+  knob = "hnsw.ef_search" if args.index == "hnsw" else "ivfflat.probes"
+  sweep = args.sweep or ([10, 20, 40, 80, 160] if args.index == "hnsw" else [1, 5, 10, 20, 50])
+  table = "vectordb_index_report"
+
+  embeddings = generate_embeddings(rng, args.rows, args.dim)
+  queries = generate_embeddings(rng, args.queries, args.dim)
+  truth = exact_neighbours(embeddings, queries, args.k)
+
+  conn = psycopg.connect(f"host={args.host} port={args.port} dbname={args.dbname} user={args.user} password={args.password}", autocommit=True)
+  conn.execute('CREATE EXTENSION IF NOT EXISTS vector')
+  register_vector(conn)
+  conn.execute(f'DROP TABLE IF EXISTS {table}')
+  conn.execute(f'CREATE TABLE {table} (id SERIAL PRIMARY KEY, embedding vector({args.dim}))')
+  try:
+    with conn.cursor() as cur:
+      cur.executemany(f'INSERT INTO {table} (embedding) VALUES (%s)', [(embedding,) for embedding in embeddings])
+
+    print(f"{args.rows} rows, {args.queries} queries, k={args.k}, {args.index} index, {args.distance} distance")
+    print()
+    print(f"| {'setting':<22} | recall@{args.k} | p50 ms | p95 ms |")
+    print(f"|{'-' * 24}|{'-' * 10}|{'-' * 8}|{'-' * 8}|")
+
+    # Exact search baseline (sequential scan)
+    results, latencies = run_queries(conn, table, operator, queries, args.k)
+    print(f"| {'exact (no index)':<22} | {recall_at_k(results, truth):>8.3f} | {np.percentile(latencies, 50):>6.2f} | {np.percentile(latencies, 95):>6.2f} |")
+
+    start = time.perf_counter()
+    if args.index == "hnsw":
+      conn.execute(f'CREATE INDEX ON {table} USING hnsw (embedding {operator_class}) WITH (m = {args.hnsw_m}, ef_construction = {args.hnsw_ef_construction})')
+    else:
+      conn.execute(f'CREATE INDEX ON {table} USING ivfflat (embedding {operator_class}) WITH (lists = {args.ivfflat_lists})')
+    build_time = time.perf_counter() - start
+
+    for value in sweep:
+      conn.execute("SELECT set_config(%s, %s, false)", (knob, str(value)))
+      results, latencies = run_queries(conn, table, operator, queries, args.k)
+      setting = f"{knob}={value}"
+      print(f"| {setting:<22} | {recall_at_k(results, truth):>8.3f} | {np.percentile(latencies, 50):>6.2f} | {np.percentile(latencies, 95):>6.2f} |")
+    print()
+    print(f"Index build time: {build_time:.2f}s")
+  finally:
+    conn.execute(f'DROP TABLE IF EXISTS {table}')
+    conn.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -81,6 +81,19 @@ export default function fileUpload() {
         body: formData
       });
       if (response.ok) {
+        // Wait for the background ingestion job to finish before refreshing the file list
+        let job = await response.json();
+        while (job.status == "queued" || job.status == "running") {
+          await new Promise((resolve) => setTimeout(resolve, 1000));
+          const jobResponse = await fetch(`${retrievalModuleURLClient}/jobs/${job.id}/`);
+          if (!jobResponse.ok) {
+            break;
+          }
+          job = await jobResponse.json();
+        }
+        if (job.status == "failed") {
+          console.error("Failed to process file: " + job.error);
+        }
         console.log("File uploaded.");
         revalidator.revalidate();
       }